@@ -9,8 +9,12 @@ import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.mlab as mlab
-import operator
 import collections
+import json
+import math
+import hashlib
+import imp
+import time
 import matplotlib.backends.backend_pdf
 
 #from operator import itemgetter
@@ -24,6 +28,30 @@ print('--o		output pdf name 						(default: output.pdf)')
 print('--filt 		\'true\' or \'false\' obtain filtered.star file 			(default: false)')
 print('--sigmafac 	cutoff for \'filt\', how many sigma above mean 			(default: 1)')
 print('--mic		minimum cutoff for CTFFIND/Gctf resolution estimate 		(default: none)')
+print('--largek 	\'true\', \'false\' or \'auto\' summary plots for many classes 	(default: auto, above 50 classes)')
+print('--topn 		number of largest classes shown in large-K plots 		(default: 20)')
+print('--converge 	\'true\' only check convergence, exit code 0 = converged 	(default: false)')
+print('--convstatus 	JSON status file written by \'converge\' 			(default: <root>_convergence.json)')
+print('--convchange 	maximum fraction of particles changing class 		(default: 0.01)')
+print('--convacc 	maximum relative change of median rotational accuracy 	(default: 0.01)')
+print('--convdrift 	maximum change between consecutive transition matrices 	(default: 0.01)')
+print('--convwindow 	number of consecutive iterations meeting all criteria 	(default: 3)')
+print('--export 	folder for memory-mappable arrays of all statistics 	(default: none)')
+print('--exportfmt 	\'npy\' or \'parquet\' (needs pyarrow) for --export 		(default: npy)')
+print('--subset 	particle list or STAR file to follow through all iterations 	(default: none)')
+print('--angdist 	\'true\' per-class orientation distributions and anisotropy 	(default: false)')
+print('--angbins 	number of rot bins for \'angdist\' (tilt gets half as many) 	(default: 24)')
+print('--split 	\'true\' write one STAR file per class of the last iteration 	(default: false)')
+print('--spatial 	\'true\' per-micrograph spatial class occupancy and segregation 	(default: false)')
+print('--spatialbins 	number of bins along x and y for \'spatial\' 			(default: 4)')
+print('--spatialmin 	fewest particles of a micrograph ranked by \'spatial\' 	(default: 20)')
+print('--topcols 	histograms only for the columns most associated with the class 	(default: 8, 0 = all columns)')
+print('--montage 	\'true\' class averages of each iteration (2D), largest first 	(default: false)')
+print('--montagen 	number of class averages per montage 			(default: 50)')
+print('--montagestep 	draw a montage every n-th iteration (last one always) 	(default: 1)')
+print('--maps 		\'true\' correlation and FSC of each class map with the previous iteration (3D) 	(default: false)')
+print('--maplowpass 	resolution (A) up to which the map correlation is computed 	(default: 10)')
+print('--cache 	folder to keep rendered pages, unchanged pages are reused 	(default: none, needs pypdf or PyPDF2)')
 
 folder = '.'
 rootname = 'run'
@@ -32,6 +60,30 @@ plottype = 'bar'
 micfilt = ''
 filtstar = 'false'
 sigmafac = 1
+largek = 'auto'
+topn = 20
+converge = 'false'
+convstatus = ''
+convchange = 0.01
+convacc = 0.01
+convdrift = 0.01
+convwindow = 3
+export = ''
+exportfmt = 'npy'
+subset = ''
+angdist = 'false'
+angbins = 24
+splitstar = 'false'
+pagecache = ''
+spatial = 'false'
+spatialbins = 4
+spatialmin = 20
+topcols = 8
+montage = 'false'
+montagen = 50
+montagestep = 1
+maps = 'false'
+maplowpass = 10.0
 
 for si, s in enumerate(sys.argv):
 	if s == '--f':
@@ -55,6 +107,324 @@ for si, s in enumerate(sys.argv):
 	if s == '--mic':
 		micfilt = sys.argv[si+1]
 
+	if s == '--largek':
+		largek = sys.argv[si+1]
+
+	if s == '--topn':
+		topn = int(sys.argv[si+1])
+
+	if s == '--converge':
+		converge = sys.argv[si+1]
+
+	if s == '--convstatus':
+		convstatus = sys.argv[si+1]
+
+	if s == '--convchange':
+		convchange = float(sys.argv[si+1])
+
+	if s == '--convacc':
+		convacc = float(sys.argv[si+1])
+
+	if s == '--convdrift':
+		convdrift = float(sys.argv[si+1])
+
+	if s == '--convwindow':
+		convwindow = int(sys.argv[si+1])
+
+	if s == '--export':
+		export = sys.argv[si+1]
+
+	if s == '--exportfmt':
+		exportfmt = sys.argv[si+1]
+
+	if s == '--subset':
+		subset = sys.argv[si+1]
+
+	if s == '--angdist':
+		angdist = sys.argv[si+1]
+
+	if s == '--angbins':
+		angbins = int(sys.argv[si+1])
+
+	if s == '--split':
+		splitstar = sys.argv[si+1]
+
+	if s == '--cache':
+		pagecache = sys.argv[si+1]
+
+	if s == '--spatial':
+		spatial = sys.argv[si+1]
+
+	if s == '--spatialbins':
+		spatialbins = int(sys.argv[si+1])
+
+	if s == '--spatialmin':
+		spatialmin = int(sys.argv[si+1])
+
+	if s == '--topcols':
+		topcols = int(sys.argv[si+1])
+
+	if s == '--montage':
+		montage = sys.argv[si+1]
+
+	if s == '--montagen':
+		montagen = int(sys.argv[si+1])
+
+	if s == '--montagestep':
+		montagestep = int(sys.argv[si+1])
+
+	if s == '--maps':
+		maps = sys.argv[si+1]
+
+	if s == '--maplowpass':
+		maplowpass = float(sys.argv[si+1])
+
+################FUNCTIONS
+
+def starcolumns(path):
+	"""Column numbers of the particle block header of a data.star file, e.g. {'_rlnClassNumber': 2}"""
+	columns = {}
+	with open(path, 'rb') as f:
+		for l in f:
+			if l.startswith('data_'):	#a new block (optics/particles) starts a new header
+				columns = {}
+			if l.startswith('_rln'):
+				columns[l.split()[0]] = int(l.split()[1][1:])-1
+			if '@' in l:
+				break
+	return columns
+
+def readclasses(path, classcolumn):
+	"""Class number of every particle row of a data.star file"""
+	classnumbers = []
+	with open(path, 'rb') as f:
+		for l in f:
+			if '@' in l:
+				classnumbers.append(int(l.split()[classcolumn]))
+	return np.array(classnumbers, dtype=int)
+
+def readaccuracy(path):
+	"""Rotational and translational accuracy of each class in a model.star file as {class: (rotation, translation)}"""
+	rotationcol = 2; translationcol = 3; accuracy = {};
+	with open(path, 'rb') as f:
+		for l in f:
+			if '_rlnAccuracyRotations' in l:
+				rotationcol = int(l.split('#')[-1])-1
+			if '_rlnAccuracyTranslations' in l:
+				translationcol = int(l.split('#')[-1])-1
+			if 'class' in l and 'mrc' in l and 'mrcs' not in l:
+				accuracy[int(l.split('.mrc')[0][-3:])] = (float(l.split()[rotationcol]), float(l.split()[translationcol]))
+			if '@' in l and 'classes.mrcs' in l:	#2D classification references are 000001@run_it025_classes.mrcs
+				accuracy[int(l.split('@')[0])] = (float(l.split()[rotationcol]), float(l.split()[translationcol]))
+	return accuracy
+
+def starrowindex(path):
+	"""Byte offsets of all particle rows of a STAR file: offsets[0] ends the header/optics block, offsets[i] starts row i
+	and offsets[-1] ends the last row (a file without particle rows gives [file size]). The index is built on first use
+	and kept in <file>.rowindex.npz, it is rebuilt when the STAR file changes."""
+	indexfile = path + '.rowindex.npz'
+	stat = os.stat(path)
+	if os.path.exists(indexfile):
+		index = np.load(indexfile)
+		if int(index['size']) == stat.st_size and float(index['mtime']) == stat.st_mtime:
+			return index['offsets']
+	data = np.memmap(path, dtype=np.uint8, mode='r')
+	linestarts = np.concatenate([[0], np.flatnonzero(data == ord('\n'))+1])
+	rowlines = np.unique(np.searchsorted(linestarts, np.flatnonzero(data == ord('@')), side='right')-1)	#lines with an @ are particle rows
+	linestarts = np.append(linestarts, stat.st_size)
+	if len(rowlines) == 0:	#header only, it ends the file
+		offsets = np.array([stat.st_size])
+	else:
+		offsets = np.append(linestarts[rowlines], linestarts[rowlines[-1]+1])
+	del data
+	try:
+		np.savez(indexfile, offsets=offsets, size=stat.st_size, mtime=stat.st_mtime)
+	except (IOError, OSError):	#read-only job folder
+		pass
+	return offsets
+
+def writestarrows(path, rows, outpath):
+	"""Copy the header and the given particle rows of a STAR file with memory-mapped slices, one write per run of consecutive rows"""
+	offsets = starrowindex(path)
+	rows = np.unique(np.asarray(rows, dtype=int))
+	data = np.memmap(path, dtype=np.uint8, mode='r')
+	with open(outpath, 'wb') as out:
+		out.write(data[:offsets[0]].tobytes())
+		if len(rows) > 0:
+			breaks = np.flatnonzero(np.diff(rows) != 1)
+			for first, last in zip(np.append(rows[0], rows[breaks+1]), np.append(rows[breaks], rows[-1])):
+				out.write(data[offsets[first]:offsets[last+1]].tobytes())
+		out.write(data[offsets[-1]:].tobytes())
+	del data
+	return len(rows)
+
+def mrcmap(path):
+	"""Memory-map the sections of an MRC file, only the header is read: array of shape (sections, ny, nx)
+	(py2 copy of read_mrc() in static/pdf/methods/mrc_io.py, which is py3 only - change both together)"""
+	header = np.fromfile(path, dtype='<i4', count=256)
+	byteorder = '<'
+	if not 0 <= header[3] < 20:	#mode does not make sense, big endian file
+		header = header.byteswap()
+		byteorder = '>'
+	nx, ny, nz, mode = header[0], header[1], header[2], header[3]
+	dtype = {0: 'i1', 1: 'i2', 2: 'f4', 6: 'u2', 12: 'f2'}[int(mode)]
+	return np.memmap(path, dtype=byteorder + dtype, mode='r', offset=1024 + int(header[23]), shape=(int(nz), int(ny), int(nx)))
+
+uniformentropycache = {}
+def uniformentropy(n, bins):
+	"""Expected entropy of the histogram of n particles spread uniformly over bins (binomial counts per bin); a
+	class of n particles without preferred orientations has this entropy, which is below log(bins) for small n"""
+	if (n, bins) not in uniformentropycache:
+		p = 1. / bins
+		k = np.arange(1, int(min(n, n*p + 12*np.sqrt(n*p) + 12)) + 1)	#the binomial mass beyond is negligible
+		logpmf = math.lgamma(n+1) - np.array([math.lgamma(ki+1) + math.lgamma(n-ki+1) for ki in k]) + k*np.log(p) + (n-k)*np.log1p(-p)
+		uniformentropycache[(n, bins)] = -bins * np.sum(np.exp(logpmf) * (k/float(n)) * np.log(k/float(n)))
+	return uniformentropycache[(n, bins)]
+
+def readpixelsize(path):
+	"""Pixel size (A) of the references in a model.star file, 1 if it is not given"""
+	with open(path, 'rb') as f:
+		for l in f:
+			if l.startswith('_rlnPixelSize'):
+				return float(l.split()[1])
+	return 1.0
+
+mapshellcache = {}
+def mapshells(shape):
+	"""Fourier shell of every element of the rfftn of a map shape and its weight in the half spectrum (2 where the
+	conjugate element is not stored), computed once per shape (py2 copy of shells() in static/pdf/methods/fourier_shells.py)"""
+	if shape not in mapshellcache:
+		size = max(shape)
+		kz = np.fft.fftfreq(shape[0])[:, None, None]
+		ky = np.fft.fftfreq(shape[1])[None, :, None]
+		kx = np.fft.rfftfreq(shape[2])[None, None, :]
+		shell = np.minimum(np.rint(np.sqrt(kz**2 + ky**2 + kx**2)*size).astype(int), size//2 + 1)	#corners beyond Nyquist go to an extra shell
+		weight = np.zeros(shell.shape) + 2
+		weight[:, :, 0] = 1
+		if shape[2] % 2 == 0:
+			weight[:, :, -1] = 1
+		mapshellcache[shape] = (shell.ravel(), weight.ravel(), size//2 + 1)
+	return mapshellcache[shape]
+
+def pagekey(name, *inputs):
+	"""Hash of a report page name and all arrays/options it is drawn from, arrays inside lists and tuples included"""
+	h = hashlib.sha1(name.encode('utf-8'))
+	def update(value):
+		if isinstance(value, np.ndarray):
+			h.update(('%s%s'%(value.shape, value.dtype)).encode('utf-8'))
+			h.update(np.ascontiguousarray(value).tobytes())
+		elif isinstance(value, (list, tuple)):	#repr() would shorten long arrays inside
+			h.update(('%s%s'%(type(value).__name__, len(value))).encode('utf-8'))
+			for v in value:
+				update(v)
+		else:
+			h.update(repr(value).encode('utf-8'))
+	for value in inputs:
+		update(value)
+	return h.hexdigest()
+
+def cachedpage(key):
+	"""True if the page was rendered before with the same inputs, it is then reused from the --cache folder"""
+	if pagecache == '' or not os.path.exists('%s/%s.pdf'%(pagecache, key)):
+		return False
+	pagefiles.append('%s/%s.pdf'%(pagecache, key))
+	reusedpages.append(key)
+	return True
+
+def savepage(key):
+	"""Save the current figure as the next report page, in the --cache folder if one is used"""
+	if pagecache == '':
+		pdf.savefig()
+	else:
+		plt.savefig('%s/%s.pdf'%(pagecache, key), format='pdf')
+		pagefiles.append('%s/%s.pdf'%(pagecache, key))
+	plt.close()
+
+def mergepages(pages, output):
+	"""Assemble the cached single page PDF files into the report"""
+	try:
+		from pypdf import PdfWriter
+		merger = PdfWriter()
+	except ImportError:
+		from PyPDF2 import PdfFileMerger
+		merger = PdfFileMerger()
+	for page in pages:
+		merger.append(page)
+	with open(output, 'wb') as f:
+		merger.write(f)
+
+def readimagenames(path):
+	"""Particle names from the _rlnImageName column of a STAR file, or from the first word of each line of a list"""
+	names = []
+	namecolumn = starcolumns(path).get('_rlnImageName', 0)
+	with open(path, 'rb') as f:
+		for l in f:
+			if '@' in l:
+				names.append(l.split()[namecolumn])
+	return names
+
+def subsetquery(bundle, names, output):
+	"""Trajectories, transitions and jump scores of a particle subset, looked up in the index of an --export folder"""
+	with open('%s/manifest.json'%bundle, 'r') as f:
+		manifest = json.load(f)
+	sortednames = np.load('%s/imagename_index.npy'%bundle, mmap_mode='r')
+	sortedrows = np.load('%s/imagename_rows.npy'%bundle, mmap_mode='r')
+	if manifest.get('format') == 'parquet':	#one column per iteration, read only the columns needed
+		import pyarrow.parquet
+		itcolumns = ['it%03d'%it for it in range(manifest['iterations'])]
+		table = pyarrow.parquet.read_table('%s/particles.parquet'%bundle, columns=['jumpscore'] + itcolumns)
+		values = lambda c: np.concatenate([chunk.to_numpy() for chunk in table.column(c).chunks])
+		assignments = np.column_stack([values(c) for c in itcolumns])
+		jumpscore = values('jumpscore')
+	else:
+		assignments = np.load('%s/assignments.npy'%bundle, mmap_mode='r')
+		jumpscore = np.load('%s/jumpscore.npy'%bundle, mmap_mode='r')
+
+	## Binary search of each requested name in the sorted index, then fancy indexing of the memory-mapped arrays
+	names = np.array(names, dtype=sortednames.dtype)
+	pos = np.minimum(np.searchsorted(sortednames, names), len(sortednames)-1)
+	found = sortednames[pos] == names
+	rows = np.sort(sortedrows[pos[found]])
+	print('')
+	print('Subset: found %s of %s particles'%(len(rows), len(names)))
+	if len(rows) == 0:
+		return
+	trajectories = np.array(assignments[rows]).astype(int)
+	scores = np.array(jumpscore[rows])
+	classes = manifest['classes']; iterations = manifest['iterations'];
+
+	## Transition matrices of the subset between consecutive iterations, one bincount for all iterations
+	codes = trajectories[:, 2:-1]*(classes+1) + trajectories[:, 3:] + (classes+1)**2*np.arange(3, iterations)
+	transitions = np.bincount(codes.ravel(), minlength=(classes+1)**2*iterations)[(classes+1)**2*3:].reshape(iterations-3, classes+1, classes+1)
+	subsetchanges = (trajectories[:, 3:] != trajectories[:, 2:-1]).mean(axis=0)
+	np.savez('%s.npz'%output[:-4], rows=rows, trajectories=trajectories, jumpscore=scores, transitions=transitions, iterations=np.arange(3, iterations))
+	print('Subset mean jump score %.4f (all particles %.4f)'%(scores.mean(), np.mean(jumpscore)))
+	if os.path.exists(manifest.get('starfile', '')):
+		writestarrows(manifest['starfile'], rows, '%s.star'%output[:-4])
+		print('Saved the subset rows of %s in %s.star'%(manifest['starfile'], output[:-4]))
+	print('Subset class sizes last iteration: %s'%np.bincount(trajectories[:, -1], minlength=classes+1)[1:].tolist())
+
+	subsetpdf = matplotlib.backends.backend_pdf.PdfPages(output)
+	plt.figure(num=None, dpi=120, facecolor='white')
+	plt.title('Class assignments of %s subset particles'%len(rows), fontsize=16, fontweight='bold')
+	plt.xlabel('Iteration #', fontsize=13)
+	plt.ylabel('Particle #', fontsize=13)
+	plt.imshow(trajectories[np.lexsort(trajectories[:, 1:].T)], aspect='auto', interpolation='nearest', cmap=plt.get_cmap('jet', classes+1), vmin=0, vmax=classes+1)
+	plt.colorbar().set_label('Class #')
+	plt.xlim(2, iterations-0.5)
+	subsetpdf.savefig()
+	plt.close()
+	plt.figure(num=None, dpi=80, facecolor='white')
+	plt.title('Subset assignment changes per iteration', fontsize=16, fontweight='bold')
+	plt.xlabel('Iteration #', fontsize=13)
+	plt.ylabel('Fraction of subset particles changed', fontsize=13)
+	plt.grid()
+	plt.plot(np.arange(3, iterations), subsetchanges, linewidth=3)
+	subsetpdf.savefig()
+	plt.close()
+	subsetpdf.close()
+	print('Saved subset plots in %s and arrays in %s.npz'%(output, output[:-4]))
+
 #### List all files in folder and sort by name
 filesdir = sorted(os.listdir(folder))
 unwanted = [];
@@ -64,7 +434,7 @@ iterationlist = []; iterationtemp = []; iterations = [];
 filesdir = sorted(filesdir)
 
 for datafile in filesdir:
-	if 'data.star' in datafile and 'sub' not in datafile:
+	if datafile.endswith('data.star') and 'sub' not in datafile:	#not the .rowindex.npz files next to them
 	   if 'it001' in datafile and len(folder) == 0:	#Get rootname by looking at first iteration if not specified
 	   	rootname = datafile.split('_it')[0]
 	   if 'ct' in datafile.split('_')[-3]:
@@ -77,11 +447,113 @@ for datafile in filesdir:
 		#	iterationtemp.append(datafile)
 	   iterations.append(int(datafile.split('_')[-2][2:]))
 
-### Open PDF for output of figures
-pdf = matplotlib.backends.backend_pdf.PdfPages('%s'%output)
-
 ## List of all input files used
 iterationlist = sorted(iterationtemp, key = lambda x: x.split('_')[-2])
+
+################################################################### PARTICLE SUBSET QUERY
+### With an existing --export folder only the subset rows are read, otherwise the full analysis runs once and builds it
+if subset != '':
+	if export == '':
+		export = '%s/%s_export'%(folder, rootname)
+	if os.path.exists('%s/imagename_index.npy'%export):
+		subsetquery(export, readimagenames(subset), '%s_subset.pdf'%output[:-4])
+		sys.exit()
+	print('No particle index in %s yet - running the full analysis first'%export)
+	exportfmt = 'npy'
+
+################################################################### CONVERGENCE CHECK OF A (RUNNING) CLASSIFICATION
+### Only new iterations are read: the last class assignments and transition counts are kept next to the JSON status file
+if converge == 'true':
+	if convstatus == '':
+		convstatus = '%s/%s_convergence.json'%(folder, rootname)
+	convstate = convstatus[:-5] + '_state.npz'
+	history = []; lastiteration = 0; lastclasses = None; lasttransition = None;
+	if os.path.exists(convstatus) and os.path.exists(convstate):
+		with open(convstatus, 'r') as f:
+			history = json.load(f)['history']
+		state = np.load(convstate)
+		lastiteration = int(state['iteration'])
+		lastclasses = state['classes']
+		lasttransition = dict(zip(state['trcodes'].tolist(), state['trcounts'].tolist()))
+
+	for datafile in iterationlist:
+		iteration = int(datafile.split('_')[-2][2:])
+		modelfile = '%s/%s_model.star'%(folder, datafile[:-10])
+		if iteration <= lastiteration or not os.path.exists(modelfile):
+			continue
+		columns = starcolumns('%s/%s'%(folder, datafile))
+		if '_rlnClassNumber' not in columns:
+			continue
+		classnumbers = readclasses('%s/%s'%(folder, datafile), columns['_rlnClassNumber'])
+		if lastclasses is not None and len(classnumbers) != len(lastclasses):
+			print('Iteration %s is incomplete (%s of %s particles) - stopping here'%(iteration, len(classnumbers), len(lastclasses)))
+			break
+		accuracy = np.array(list(readaccuracy(modelfile).values()))
+		if lastclasses is not None and iteration > 1:
+			## Change fraction, median accuracies and drift of the sparse transition matrix
+			maxclass = max(classnumbers.max(), lastclasses.max())+1
+			trcodes, trcounts = np.unique(lastclasses*maxclass + classnumbers, return_counts=True)
+			trcodes = (trcodes // maxclass)*1000000 + trcodes % maxclass	#class numbers independent of maxclass
+			transition = dict(zip(trcodes.tolist(), trcounts.tolist()))
+			drift = float('nan')
+			if lasttransition is not None:
+				drift = 0.5*sum(abs(transition.get(k, 0) - lasttransition.get(k, 0)) for k in set(transition) | set(lasttransition)) / float(len(classnumbers))
+			rotacc = transacc = accchange = 0.0
+			if len(accuracy) > 0:
+				rotacc = float(np.median(accuracy[:, 0]))
+				transacc = float(np.median(accuracy[:, 1]))
+			if len(history) > 0 and history[-1]['rot_accuracy'] > 0:
+				accchange = abs(rotacc - history[-1]['rot_accuracy']) / history[-1]['rot_accuracy']
+			changefraction = np.sum(classnumbers != lastclasses) / float(len(classnumbers))
+			history.append({'iteration': iteration, 'change_fraction': float(changefraction), 'rot_accuracy': rotacc, 'trans_accuracy': transacc, 'accuracy_change': accchange, 'transition_drift': drift if drift == drift else None})
+			print('Iteration %s: %.4f changed, accuracy change %.4f, transition drift %s'%(iteration, changefraction, accchange, drift))
+			lasttransition = transition
+		lastclasses = classnumbers
+		lastiteration = iteration
+
+	if lastclasses is None:
+		print('')
+		print('I cannot find any finished iteration in the provided folder!')
+		sys.exit(2)
+
+	## Entries of earlier polls are judged again with the current criteria
+	for h in history:
+		drift = h['transition_drift']
+		h['passed'] = bool(h['change_fraction'] <= convchange and h['accuracy_change'] <= convacc and (drift is not None and drift <= convdrift))
+	converged = len(history) >= convwindow and all(h['passed'] for h in history[-convwindow:])
+	status = {'converged': converged, 'iteration': lastiteration, 'particles': len(lastclasses), 'updated': time.strftime('%Y-%m-%d %H:%M:%S'),
+		'criterion': {'change_fraction': convchange, 'accuracy_change': convacc, 'transition_drift': convdrift, 'window': convwindow}, 'history': history}
+	if lasttransition is None:
+		lasttransition = {}
+	np.savez(convstate, iteration=lastiteration, classes=lastclasses, trcodes=np.array(list(lasttransition.keys()), dtype=int), trcounts=np.array(list(lasttransition.values()), dtype=int))
+	with open(convstatus + '.tmp', 'w') as f:	#rename is atomic, a polling scheduler never sees a half written file
+		json.dump(status, f, indent=1)
+	os.rename(convstatus + '.tmp', convstatus)
+	print('')
+	print('Iteration %s: converged = %s, status saved in %s'%(lastiteration, converged, convstatus))
+	if converged:
+		sys.exit(0)
+	sys.exit(1)
+
+### Open PDF for output of figures, or the folder of cached pages
+pagefiles = []; reusedpages = [];
+if pagecache != '':
+	found = False
+	for module in ('pypdf', 'PyPDF2'):	#only checked here, imported when the pages are merged
+		try:
+			imp.find_module(module)
+			found = True
+			break
+		except ImportError:
+			pass
+	if not found:
+		print('Page caching needs pypdf or PyPDF2 - rendering all pages')
+		pagecache = ''
+if pagecache != '' and not os.path.exists(pagecache):
+	os.makedirs(pagecache)
+if pagecache == '':
+	pdf = matplotlib.backends.backend_pdf.PdfPages('%s'%output)
+
 if len(iterations) == 0:
 	print('')
 	print('I cannot find any data.star files in the provided folder!')
@@ -95,9 +567,9 @@ for files in iterationlist:
 	print('Using %s as input'%files)
 
 ##Check number of particles, number of classes, number of micrographs
-part = 0; classes = []; micrographlist = []; checklist = []; checklistcol = []; anglerot = []; rescol = [];
+part = 0; classes = []; micrographlist = []; imagelist = []; checklist = []; checklistcol = []; anglerot = []; angletilt = []; rescol = [];
 
-with open('%s/%s_it016_data.star'%(folder, rootname), 'rb') as f:
+with open('%s/%s'%(folder, iterationlist[-1]), 'rb') as f:	#header of the last iteration
 	for l in f:
 		if l[0] == '_' and 10 < len(l) < 50: #check header
 		   if l.split()[0] == '_rlnClassNumber': #check header for ClassNumber column
@@ -108,6 +580,8 @@ with open('%s/%s_it016_data.star'%(folder, rootname), 'rb') as f:
 			particolumn = int(l.split()[1][1:])-1
 		   if l.split()[0] == '_rlnAngleRot': #check header for ParticleName column
 			anglerot = int(l.split()[1][1:])-1
+		   if l.split()[0] == '_rlnAngleTilt': #check header for AngleTilt column
+			angletilt = int(l.split()[1][1:])-1
  		   if l.split()[0] == '_rlnCtfMaxResolution': #check header for CtfMaxResolution column
 			rescol = int(l.split()[1][1:])-1
 
@@ -119,49 +593,75 @@ with open('%s/%s_it016_data.star'%(folder, rootname), 'rb') as f:
 			part+=1
 			classes.append(int(l.split()[classcolumn]))
 			micrographlist.append(l.split()[miccolumn])
+			imagelist.append(l.split()[particolumn])
 
 classes = max(classes)
+columnnames = checklistcol[len(checklistcol)-int(checklist[-1])-1:]	#particle block columns only (no optics block)
+
+### Micrograph index of every particle (sorted by micrograph name)
+micnames, micidx = np.unique(micrographlist, return_inverse=True)
+
+### Large-K mode (e.g. 2D classification with 100-300 classes): sparse statistics and top-N summary plots
+if largek == 'auto':
+	if int(classes) > 50:
+		largek = 'true'
+	else:
+		largek = 'false'
+if largek == 'true':
+	topn = min(topn, int(classes))
+	print('')
+	print('Large-K mode: %s classes, plots will summarize the %s largest classes'%(classes, topn))
 
 print('')
 print('Plots will be generated for the following columns:', checklistcol)
 
-## Initial colorbar
-fig = plt.figure()
-ax1 = fig.add_axes([0.05, 0.80, 0.9, 0.15])
-cmap = plt.get_cmap('jet', int(classes)+1)
-norm = matplotlib.colors.Normalize(vmin=1, vmax=int(classes)+2)
-#ticks = np.arange(1, int(classes)+1)
-cb1 = matplotlib.colorbar.ColorbarBase(ax1, cmap=cmap, norm=norm, orientation='horizontal')
-#colorbar stuff
-labels = np.arange(0, classes+2)
-#cb1 = plt.colorbar(mat, ticks=labels)
-loc = labels + .5
-cb1.set_ticks(loc)
-cb1.set_ticklabels(labels)
-cb1.ax.tick_params(labelsize=16)
-cb1.set_label('Class #')
-cb1.set_label('Color for each class')
-#cb1.set_label('Class \'0\' means unassigned when using small subset')
-a=ax1.get_xticks().tolist()
-a[0]='no class'
-a[1:-1]=labels[1:-1]
-ax1.set_xticklabels(a)
-
-pdf.savefig()
-#plt.show()
+## Initial colorbar (large-K mode draws a top-N color key once the final class sizes are known)
+if largek != 'true':
+	labels = np.arange(0, classes+2)
+	a = ['no class'] + labels[1:].tolist()
+	key = pagekey('colorbar', classes)
+	if not cachedpage(key):
+		fig = plt.figure()
+		ax1 = fig.add_axes([0.05, 0.80, 0.9, 0.15])
+		cmap = plt.get_cmap('jet', int(classes)+1)
+		norm = matplotlib.colors.Normalize(vmin=1, vmax=int(classes)+2)
+		#ticks = np.arange(1, int(classes)+1)
+		cb1 = matplotlib.colorbar.ColorbarBase(ax1, cmap=cmap, norm=norm, orientation='horizontal')
+		#colorbar stuff
+		labels = np.arange(0, classes+2)
+		#cb1 = plt.colorbar(mat, ticks=labels)
+		loc = labels + .5
+		cb1.set_ticks(loc)
+		cb1.set_ticklabels(labels)
+		cb1.ax.tick_params(labelsize=16)
+		cb1.set_label('Class #')
+		cb1.set_label('Color for each class')
+		#cb1.set_label('Class \'0\' means unassigned when using small subset')
+		ax1.set_xticklabels(a)
+
+		savepage(key)
 
 ###### Go into each iteration_data.star file and read in information, such as particle class assignments etc.
 groupnumarray = np.zeros((part, iterations), dtype=np.double) # Class assignments over all iterations
-checkarray = np.empty((part, len(checklist)), dtype=np.double) # Stats of final iteration
+checkarray = np.empty((part, len(checklist)), dtype=np.double, order='F') # Stats of final iteration, column-major so every column is contiguous
 check = np.empty((part, 2, iterations), dtype=np.double) # Stats of final iteration
 changes = [];
 
-micnumdict = collections.defaultdict(list)
+micocc = []; transitions = [];
+
+### Orientations per class: rot in equal steps, cos(tilt) in equal steps, so that every bin covers the same area on the sphere
+if angdist == 'true' and (anglerot == [] or angletilt == []):
+	print('No _rlnAngleRot/_rlnAngleTilt columns found - skipping angular distributions')
+	angdist = 'false'
+if angdist == 'true':
+	tiltbins = max(angbins // 2, 1)
+	rotarray = np.zeros(part, dtype=np.double)
+	tiltarray = np.zeros(part, dtype=np.double)
+	angcounts = np.zeros((iterations, int(classes)+1, angbins, tiltbins), dtype=np.int32)
 
 print('')
 for datafile in iterationlist:
 
-	miciterdict = collections.defaultdict(list)
 	if 'ct' in datafile:
 	   	iteration = int(datafile.split('_')[-2][2:])
 	if 'ct' not in datafile:
@@ -180,7 +680,6 @@ for datafile in iterationlist:
 					particlename = l.split()[particolumn] 	## Particle Name
 
 					groupnumarray[particle, iteration] = groupnum
-					miciterdict[micrograph].append(groupnum)
 					if int(iteration) == iterations-1: 	#last iteration: all columns of star file to checkarray
 					  for i in range(0, int(checklist[-1]+1)):
 						if 'mrc' not in l.split()[i]:	#No filenames in checklist
@@ -196,6 +695,10 @@ for datafile in iterationlist:
 							check[particle, 0, iteration] = l.split()[anglerot]
 							check[particle, 1, iteration] = l.split()[classcolumn]
 
+					if angdist == 'true':
+						rotarray[particle] = l.split()[anglerot]
+						tiltarray[particle] = l.split()[angletilt]
+
 					if groupnumarray[particle, iteration] == groupnumarray[particle, int(iteration)-1]:
 						change = 'nan';
 						change1 = 0;
@@ -209,33 +712,274 @@ for datafile in iterationlist:
 
 	print("Iteration %s: %s particles changed class assignments"%(iteration, changesum))
 
-	## After each iteration create Histogram of class assignments for each micrograph
-	miciterdict = collections.OrderedDict(sorted(miciterdict.items(), key=operator.itemgetter(0)))
-	for key, value in miciterdict.iteritems():
-		michisto = []
-		for numb in value:
-			michisto.append(float(numb))
+	## After each iteration create Histogram of class assignments for each micrograph, stored sparse as (micrograph, class, count)
+	if int(iteration) > 1:
 		classes = int(classes)
-		michisto = np.histogram(michisto, bins=classes, range=(1, classes+1))
-		micnumdict[key].append(michisto[0].tolist())
+		assigned = groupnumarray[:, iteration] > 0
+		miccodes = micidx[assigned]*classes + groupnumarray[assigned, iteration].astype(int)-1
+		miccodes, miccounts = np.unique(miccodes, return_counts=True)
+		micocc.append((iteration, miccodes // classes, miccodes % classes, miccounts))
+
+	## Orientation histogram of every class in one bincount over (class, rot bin, tilt bin)
+	if int(iteration) > 1 and angdist == 'true':
+		rotbin = np.clip(((rotarray + 180.) / 360. * angbins).astype(int), 0, angbins-1)
+		tiltbin = np.clip(((1. - np.cos(np.radians(tiltarray))) / 2. * tiltbins).astype(int), 0, tiltbins-1)
+		angcodes = (groupnumarray[:, iteration].astype(int)*angbins + rotbin)*tiltbins + tiltbin
+		angcounts[iteration] = np.bincount(angcodes, minlength=(int(classes)+1)*angbins*tiltbins).reshape(int(classes)+1, angbins, tiltbins)
+
+	## Class transitions from the previous iteration, stored sparse as (previous class, class, count)
+	if int(iteration) > 2:
+		trcodes = groupnumarray[:, iteration-1].astype(int)*(classes+1) + groupnumarray[:, iteration].astype(int)
+		trcodes, trcounts = np.unique(trcodes, return_counts=True)
+		transitions.append((iteration, trcodes // (classes+1), trcodes % (classes+1), trcounts))
+
+### Class sizes of all iterations in one bincount over iteration-offset class numbers
+classsizes = np.bincount((groupnumarray.astype(int) + (int(classes)+1)*np.arange(iterations)).ravel(), minlength=iterations*(int(classes)+1)).reshape(iterations, int(classes)+1)
+
+if largek == 'true':
+	### Rank classes by size in the last iteration: 0 = no class, 1..topn = largest classes, topn+1 = all other classes
+	topclasses = np.argsort(classsizes[-1, 1:])[::-1][:topn]+1
+	rankmap = np.zeros(int(classes)+1, dtype=int) + topn+1
+	rankmap[0] = 0
+	rankmap[topclasses] = np.arange(1, topn+1)
+	jet = plt.get_cmap('jet', topn)
+	rankcmap = matplotlib.colors.ListedColormap(['white'] + [jet(i) for i in range(topn)] + ['lightgrey'])
+	ranknorm = matplotlib.colors.Normalize(vmin=0, vmax=topn+2)
+	ranklabels = ['no class'] + ['%s'%c for c in topclasses] + ['other']
+
+	## Color key of the largest classes
+	key = pagekey('colorkey', topclasses, classes)
+	if not cachedpage(key):
+		fig = plt.figure()
+		ax1 = fig.add_axes([0.05, 0.80, 0.9, 0.15])
+		cb1 = matplotlib.colorbar.ColorbarBase(ax1, cmap=rankcmap, norm=ranknorm, orientation='horizontal')
+		cb1.set_ticks(np.arange(0, topn+2) + .5)
+		cb1.set_ticklabels(ranklabels)
+		cb1.ax.tick_params(labelsize=8, rotation=90)
+		cb1.set_label('Color for the %s largest of %s classes (last iteration)'%(topn, classes))
+		savepage(key)
+
+	## Small multiples: size of the largest classes over all iterations
+	key = pagekey('classsizes', classsizes[:, topclasses], topclasses)
+	if not cachedpage(key):
+		ncols = int(np.ceil(np.sqrt(topn)))
+		nrows = int(np.ceil(topn/float(ncols)))
+		fig, axes = plt.subplots(nrows, ncols, sharex=True, sharey=True, figsize=(11, 8.5), squeeze=False)
+		fig.suptitle('Particles per class - %s largest classes'%topn, fontsize=16, fontweight='bold')
+		for ri, ax in enumerate(axes.ravel()):
+			if ri >= topn:
+				ax.axis('off')
+				continue
+			ax.plot(np.arange(2, iterations), classsizes[2:, topclasses[ri]], linewidth=2, color=rankcmap(ri+1))
+			ax.set_title('Class %s'%topclasses[ri], fontsize=8)
+			ax.tick_params(labelsize=6)
+			ax.grid()
+		savepage(key)
+
+	## Distribution of all class sizes in the last iteration
+	key = pagekey('sizedistribution', classsizes[-1], topclasses, part)
+	if not cachedpage(key):
+		plt.figure(num=None, dpi=80, facecolor='white')
+		plt.title('Class size distribution - last iteration', fontsize=16, fontweight='bold')
+		plt.xlabel('Class rank', fontsize=13)
+		plt.ylabel('# particles', fontsize=13)
+		plt.grid()
+		plt.bar(np.arange(1, int(classes)+1), np.sort(classsizes[-1, 1:])[::-1], width=1.0, color='lightgrey')
+		plt.bar(np.arange(1, topn+1), classsizes[-1, topclasses], width=1.0, color=[rankcmap(ri+1) for ri in range(topn)])
+		plt.figtext(0, 0, 'The %s largest classes hold %s of %s particles'%(topn, classsizes[-1, topclasses].sum(), part))
+		savepage(key)
+
+######## Class averages of each iteration (2D classification), ordered by class size
+### Only the header and the shown sections of each run_itNNN_classes.mrcs stack are read, one iteration at a time
+if montage == 'true':
+	for datafile in iterationlist:
+		iteration = int(datafile.split('_')[-2][2:])
+		stackfile = '%s/%s_classes.mrcs'%(folder, datafile[:-10])
+		if iteration < 2 or not os.path.exists(stackfile) or (iteration % montagestep != 0 and iteration != iterations-1):
+			continue
+		stack = mrcmap(stackfile)
+		shown = np.argsort(classsizes[iteration, 1:], kind='mergesort')[::-1][:min(montagen, len(stack))]	#0-based class index
+		binning = max(1, stack.shape[1] // 64)
+		box = stack.shape[1] // binning
+		tiles = np.array([stack[c, :box*binning, :box*binning] for c in shown], dtype=np.float32).reshape(len(shown), box, binning, box, binning).mean(axis=(2, 4))
+		del stack
+		tiles -= tiles.mean(axis=(1, 2))[:, None, None]
+		tiles /= np.maximum(tiles.std(axis=(1, 2)), 1e-6)[:, None, None]
+		key = pagekey('montage%s'%iteration, tiles, classsizes[iteration, shown+1])
+		if not cachedpage(key):
+			ncols = int(np.ceil(np.sqrt(len(shown))))
+			nrows = int(np.ceil(len(shown)/float(ncols)))
+			sheet = np.zeros((nrows*box, ncols*box), dtype=np.float32) + np.min(tiles)
+			for ti in range(len(shown)):
+				sheet[(ti // ncols)*box:(ti // ncols + 1)*box, (ti % ncols)*box:(ti % ncols + 1)*box] = tiles[ti]
+			plt.figure(num=None, dpi=120, facecolor='white', figsize=(8.5, 8.5))
+			plt.title('Class averages iteration %s - largest first'%iteration, fontsize=16, fontweight='bold')
+			plt.imshow(sheet, cmap='Greys_r', interpolation='nearest', vmin=-3, vmax=3)
+			for ti, c in enumerate(shown):
+				plt.text((ti % ncols)*box + 1, (ti // ncols)*box + 1, '%s: %s'%(c+1, classsizes[iteration, c+1]), color='yellow', fontsize=5, va='top')
+			plt.axis('off')
+			savepage(key)
+
+######## Structural convergence of the class maps (3D classification)
+### Each run_itNNN_classXXX.mrc is memory-mapped and transformed once; its spectrum is compared with the same class of the
+### previous iteration and then replaces it, so only the spectra of two iterations are held in memory
+if maps == 'true':
+	mapcorr = np.zeros((iterations, int(classes)), dtype=np.double) + np.nan	#correlation of the maps low-pass filtered to maplowpass
+	mapres = np.zeros((iterations, int(classes)), dtype=np.double) + np.nan	#resolution (A) where the FSC drops below 0.5
+	mapfsc = {}	#class: (1/resolution, FSC) of the last comparison
+	previous = {}
+	for datafile in iterationlist:
+		iteration = int(datafile.split('_')[-2][2:])
+		pixel = readpixelsize('%s/%s_model.star'%(folder, datafile[:-10]))
+		current = {}
+		for c in range(1, int(classes)+1):
+			mapfile = '%s/%s_class%03d.mrc'%(folder, datafile[:-10], c)
+			if not os.path.exists(mapfile):
+				continue
+			volume = mrcmap(mapfile)
+			shell, weight, nshell = mapshells(volume.shape)
+			spectrum = np.fft.rfftn(volume).astype(np.complex64).ravel()
+			spectrum[0] = 0	#mean density
+			current[c] = spectrum
+			if c in previous and previous[c].shape == spectrum.shape:
+				cross = np.bincount(shell, weight*(spectrum*np.conj(previous[c])).real, nshell+1)[:nshell]
+				power1 = np.bincount(shell, weight*np.abs(spectrum)**2, nshell+1)[:nshell]
+				power2 = np.bincount(shell, weight*np.abs(previous[c])**2, nshell+1)[:nshell]
+				fsc = cross / np.maximum(np.sqrt(power1*power2), 1e-30)
+				size = max(volume.shape)
+				lowpass = min(nshell, int(size*pixel/maplowpass) + 1)	#shells up to maplowpass A
+				mapcorr[iteration, c-1] = cross[1:lowpass].sum() / max(np.sqrt(power1[1:lowpass].sum()*power2[1:lowpass].sum()), 1e-30)
+				below = np.flatnonzero(fsc[1:] < 0.5)
+				mapres[iteration, c-1] = size*pixel / (below[0]+1 if len(below) > 0 else nshell-1)
+				mapfsc[c] = (np.arange(nshell) / (size*pixel), fsc)
+			del volume
+		previous = current
+
+	mapshown = np.arange(1, int(classes)+1)
+	if largek == 'true':
+		mapshown = topclasses
+	if len(mapfsc) == 0:
+		print('No class maps (run_itNNN_classXXX.mrc) of consecutive iterations found - skipping the map plots!')
+	else:
+		print('')
+		for c in mapshown:
+			print('Class %s: map correlation with the previous iteration %.4f, FSC 0.5 at %.1f A'%(c, mapcorr[-1, c-1], mapres[-1, c-1]))
+
+		## Correlation of each class map with the previous iteration
+		key = pagekey('mapcorrelation', mapcorr, mapshown, maplowpass)
+		if not cachedpage(key):
+			plt.figure(num=None, dpi=80, facecolor='white')
+			plt.title('Class map correlation with previous iteration', fontsize=16, fontweight='bold')
+			plt.xlabel('Iteration #', fontsize=13)
+			plt.ylabel('Correlation (%s A low-pass)'%maplowpass, fontsize=13)
+			plt.grid()
+			cmap = plt.get_cmap('jet', int(classes)+1)
+			for c in mapshown:
+				plt.plot(np.arange(iterations), mapcorr[:, c-1], linewidth=2, color=cmap(c), label='Class %s'%c)
+			plt.xlim(2, iterations)
+			if len(mapshown) <= 20:
+				plt.legend(loc='best', fontsize=8)
+			plt.figtext(0, 0, 'Values close to 1 mean the map of a class no longer changes')
+			savepage(key)
+
+		## Resolution at which consecutive maps stop agreeing
+		key = pagekey('mapresolution', mapres, mapshown)
+		if not cachedpage(key):
+			plt.figure(num=None, dpi=80, facecolor='white')
+			plt.title('FSC 0.5 between consecutive iterations', fontsize=16, fontweight='bold')
+			plt.xlabel('Iteration #', fontsize=13)
+			plt.ylabel('Resolution (A)', fontsize=13)
+			plt.grid()
+			cmap = plt.get_cmap('jet', int(classes)+1)
+			for c in mapshown:
+				plt.plot(np.arange(iterations), mapres[:, c-1], linewidth=2, color=cmap(c), label='Class %s'%c)
+			plt.xlim(2, iterations)
+			if len(mapshown) <= 20:
+				plt.legend(loc='best', fontsize=8)
+			savepage(key)
+
+		## FSC curves of the last comparison
+		key = pagekey('mapfsc', [mapfsc[c] for c in mapshown if c in mapfsc], mapshown)
+		if not cachedpage(key):
+			plt.figure(num=None, dpi=80, facecolor='white')
+			plt.title('FSC with previous iteration - last iteration', fontsize=16, fontweight='bold')
+			plt.xlabel('Spatial frequency (1/A)', fontsize=13)
+			plt.ylabel('FSC', fontsize=13)
+			plt.grid()
+			cmap = plt.get_cmap('jet', int(classes)+1)
+			for c in mapshown:
+				if c in mapfsc:
+					plt.plot(mapfsc[c][0][1:], mapfsc[c][1][1:], linewidth=2, color=cmap(c), label='Class %s'%c)
+			plt.axhline(0.5, color='black', linestyle='--')
+			plt.ylim(-0.1, 1.05)
+			if len(mapshown) <= 20:
+				plt.legend(loc='best', fontsize=8)
+			savepage(key)
+
+######## Orientation distribution and anisotropy of each class
+if angdist == 'true':
+	### Anisotropy = 1 - entropy of the orientation histogram / entropy expected for uniform orientations of as many particles:
+	### about 0 for uniform coverage and 1 for a single view, whatever the class size (the plain entropy is biased low for small classes)
+	angprob = angcounts[:, 1:].reshape(iterations, int(classes), -1).astype(np.double)
+	angtotal = angprob.sum(axis=2)
+	angprob = angprob / np.maximum(angtotal, 1)[:, :, None]
+	entropy = -np.sum(np.where(angprob > 0, angprob * np.log(np.where(angprob > 0, angprob, 1)), 0), axis=2)
+	uniform = np.zeros(angtotal.shape)
+	for n in np.unique(angtotal[angtotal > 1]):
+		uniform[angtotal == n] = uniformentropy(int(n), angbins*tiltbins)
+	anisotropy = np.where(uniform > 0, 1 - entropy / np.where(uniform > 0, uniform, 1), np.nan)
+	angshown = np.arange(1, int(classes)+1)
+	if largek == 'true':
+		angshown = topclasses
+	print('')
+	for c in angshown:
+		print('Class %s: orientation anisotropy %.3f (%s particles)'%(c, anisotropy[-1, c-1], int(angtotal[-1, c-1])))
+
+	## Small multiples of the orientation distribution of each class in the last iteration
+	key = pagekey('orientations', angcounts[-1], anisotropy[-1], angshown)
+	if not cachedpage(key):
+		ncols = int(np.ceil(np.sqrt(len(angshown))))
+		nrows = int(np.ceil(len(angshown)/float(ncols)))
+		fig, axes = plt.subplots(nrows, ncols, sharex=True, sharey=True, figsize=(11, 8.5), squeeze=False)
+		fig.suptitle('Orientation distribution per class - last iteration', fontsize=16, fontweight='bold')
+		for ai, ax in enumerate(axes.ravel()):
+			if ai >= len(angshown):
+				ax.axis('off')
+				continue
+			c = angshown[ai]
+			ax.imshow(angcounts[-1, c].T, aspect='auto', interpolation='nearest', origin='lower', extent=(-180, 180, -1, 1), cmap='viridis')
+			ax.set_title('Class %s: anisotropy %.2f'%(c, anisotropy[-1, c-1]), fontsize=8)
+			ax.tick_params(labelsize=6)
+		fig.text(0.5, 0.04, 'Rot (degrees)', ha='center')
+		fig.text(0.04, 0.5, '-cos(Tilt) (equal area bins)', va='center', rotation='vertical')
+		savepage(key)
+
+	## Anisotropy over iterations
+	key = pagekey('anisotropy', anisotropy, angshown)
+	if not cachedpage(key):
+		plt.figure(num=None, dpi=80, facecolor='white')
+		plt.title('Orientation anisotropy per class', fontsize=16, fontweight='bold')
+		plt.xlabel('Iteration #', fontsize=13)
+		plt.ylabel('1 - entropy / entropy of uniform orientations', fontsize=13)
+		plt.grid()
+		cmap = plt.get_cmap('jet', int(classes)+1)
+		for c in angshown:
+			plt.plot(np.arange(2, iterations), anisotropy[2:, c-1], linewidth=2, color=cmap(c), label='Class %s'%c)
+		plt.xlim(2, iterations)
+		if len(angshown) <= 20:
+			plt.legend(loc='best', fontsize=8)
+		plt.figtext(0, 0, 'High values mean a class is dominated by preferred orientations')
+		savepage(key)
 
 ######## Plot rotational and translational accuracy over each iteration
-rotationcol = 2; translationcol = 3;
 rotation = np.zeros((int(classes)+1, iterations), dtype=np.double);
 translation = np.zeros((int(classes)+1, iterations), dtype=np.double);
 
 for datafile in iterationlist:
 	iteration = int(datafile.split('_')[-2][2:])
-	with open('%s/%s_model.star'%(folder, datafile[:-10]), 'rb') as f:
-		for l in f:
-			if '_rlnAccuracyRotations' in l:
-				rotationcol = int(l.split('#')[-1])-1
-			if '_rlnAccuracyTranslations' in l:
-				translationcol = int(l.split('#')[-1])-1
-			if 'class' in l and 'mrc' in l and 'mrcs' not in l:
-				classnum = int(l.split('.mrc')[0][-3:])
-				rotation[classnum, iteration] = l.split()[rotationcol]
-				translation[classnum, iteration] = l.split()[translationcol]
+	for classnum, acc in readaccuracy('%s/%s_model.star'%(folder, datafile[:-10])).items():
+		rotation[classnum, iteration] = acc[0]
+		translation[classnum, iteration] = acc[1]
 
 rotation = np.array(rotation[1:])
 translation = np.array(translation[1:])
@@ -243,43 +987,65 @@ translation = np.array(translation[1:])
 if len(set(rotation[0])) == 1:
 	print('You did not perform image alignment during classification - skipping these two plots!')
 
-if len(set(rotation[0])) > 1:
+if len(set(rotation[0])) > 1 and largek == 'true':	#Percentile bands over all classes instead of one line per class
+	for accname, acc in [('RotationalAccuracy', rotation), ('TranslationalAccuracy', translation)]:
+		key = pagekey(accname, acc, topclasses, classes)
+		if not cachedpage(key):
+			pct = np.percentile(acc, [5, 25, 50, 75, 95], axis=0)
+			x = np.arange(iterations)
+			plt.figure(num=None, dpi=80, facecolor='white')
+			plt.title('%s - %s classes'%(accname, classes), fontsize=16, fontweight='bold')
+			plt.xlabel('Iteration #', fontsize=13)
+			plt.ylabel(accname, fontsize=13)
+			plt.grid()
+			plt.fill_between(x, pct[0], pct[4], color='lightgrey', label='5-95 percentile')
+			plt.fill_between(x, pct[1], pct[3], color='darkgrey', label='25-75 percentile')
+			plt.plot(x, pct[2], linewidth=3, color='black', label='Median')
+			for ri, c in enumerate(topclasses[:5]):
+				plt.plot(x, acc[c-1], linewidth=1, color=rankcmap(ri+1), label='Class %s'%c)
+			plt.xlim(2, iterations)
+			plt.legend(loc='best', fontsize=8)
+			savepage(key)
+
+if len(set(rotation[0])) > 1 and largek != 'true':
 
 #Rotational
-	cmap = plt.get_cmap('jet', int(classes)+1)
-	plt.figure(num=None, dpi=80, facecolor='white')
-	plt.title('RotationalAccuracy', fontsize=16, fontweight='bold')
-	plt.xlabel('Iteration #', fontsize=13)
-	plt.ylabel('RotationalAccuracy', fontsize=13)
-	plt.grid()
-	colors = np.arange(1, int(classes)+1)
-	d = 0;
-	for c, r in zip(colors, rotation):
-		d = c
-		plt.plot(r[:], linewidth=3, color=cmap(c), label='Class %s'%d)
-	ticks = np.arange(2, iterations)
-	plt.xlim(2, iterations)
-	plt.legend(loc='best')
-	pdf.savefig()
-	#plt.show()
+	key = pagekey('RotationalAccuracy', rotation, classes, iterations)
+	if not cachedpage(key):
+		cmap = plt.get_cmap('jet', int(classes)+1)
+		plt.figure(num=None, dpi=80, facecolor='white')
+		plt.title('RotationalAccuracy', fontsize=16, fontweight='bold')
+		plt.xlabel('Iteration #', fontsize=13)
+		plt.ylabel('RotationalAccuracy', fontsize=13)
+		plt.grid()
+		colors = np.arange(1, int(classes)+1)
+		d = 0;
+		for c, r in zip(colors, rotation):
+			d = c
+			plt.plot(r[:], linewidth=3, color=cmap(c), label='Class %s'%d)
+		ticks = np.arange(2, iterations)
+		plt.xlim(2, iterations)
+		plt.legend(loc='best')
+		savepage(key)
 
 #Translational
-	cmap = plt.get_cmap('jet', int(classes)+1)
-	plt.figure(num=None, dpi=80, facecolor='white')
-	plt.title('TranslationalAccuracy', fontsize=16, fontweight='bold')
-	plt.xlabel('Iteration #', fontsize=13)
-	plt.ylabel('TranslationalAccuracy', fontsize=13)
-	plt.grid()
-	colors = np.arange(1, int(classes)+1)
-	d=0
-	for c, t in zip(colors, translation):
-		d = c;
-		plt.plot(t[:], linewidth=3, color=cmap(c), label='Class %s'%d)
-	ticks = np.arange(2, iterations)
-	plt.xlim(2, iterations)
-	plt.legend(loc='best')
-	pdf.savefig()
-	#plt.show()
+	key = pagekey('TranslationalAccuracy', translation, classes, iterations)
+	if not cachedpage(key):
+		cmap = plt.get_cmap('jet', int(classes)+1)
+		plt.figure(num=None, dpi=80, facecolor='white')
+		plt.title('TranslationalAccuracy', fontsize=16, fontweight='bold')
+		plt.xlabel('Iteration #', fontsize=13)
+		plt.ylabel('TranslationalAccuracy', fontsize=13)
+		plt.grid()
+		colors = np.arange(1, int(classes)+1)
+		d=0
+		for c, t in zip(colors, translation):
+			d = c;
+			plt.plot(t[:], linewidth=3, color=cmap(c), label='Class %s'%d)
+		ticks = np.arange(2, iterations)
+		plt.xlim(2, iterations)
+		plt.legend(loc='best')
+		savepage(key)
 
 ###########################################################################
 
@@ -287,55 +1053,66 @@ if len(set(rotation[0])) > 1:
 sortindices = np.lexsort(groupnumarray[:,1:].T)
 groupnumarraysorted = groupnumarray[sortindices]
 
+### Carpet plots color every class, or only the largest classes in large-K mode
+if largek != 'true':
+	carpet = groupnumarraysorted
+	carpetcmap = plt.get_cmap('jet', int(classes)+1)
+	carpetnorm = matplotlib.colors.Normalize(vmin=0, vmax=int(classes)+1)
+	labels = np.arange(0, classes+2)
+	carpetfont = 16
+if largek == 'true':
+	carpet = rankmap[groupnumarraysorted.astype(int)]
+	carpetcmap = rankcmap
+	carpetnorm = ranknorm
+	labels = np.arange(0, topn+2)
+	a = ranklabels
+	carpetfont = 8
+
 ### Heat map of group sizes
-H = groupnumarraysorted[:,:]
-cmap = plt.get_cmap('jet', int(classes)+1)
-norm = matplotlib.colors.Normalize(vmin=0, vmax=int(classes)+1)
-plt.figure(num=None, dpi=120, facecolor='white')
-plt.title('Class assignments of each particle', fontsize=16, fontweight='bold')
-plt.xlabel('Iteration #', fontsize=13)
-plt.ylabel('Particle #', fontsize=13)
-mat = plt.imshow(H,aspect='auto', interpolation="nearest", cmap=cmap, norm=norm)
-#colorbar stuff
-labels = np.arange(0, classes+2)
-#labels[-1] = 'unassigned'
-cb1 = plt.colorbar(mat, ticks=labels)
-loc = labels + .5
-#print loc
-cb1.set_ticks(loc)
-a[0]='no class'
-a[1:-1]=labels[1:-1]
-cb1.set_ticklabels(a)
-cb1.ax.tick_params(labelsize=16)
-cb1.set_label('Class #')
-plt.xlim(2, iterations-0.5)
-
-
-pdf.savefig()
-#plt.show()
+key = pagekey('carpet', carpet, a, labels, iterations)
+if not cachedpage(key):
+	H = carpet
+	cmap = carpetcmap
+	norm = carpetnorm
+	plt.figure(num=None, dpi=120, facecolor='white')
+	plt.title('Class assignments of each particle', fontsize=16, fontweight='bold')
+	plt.xlabel('Iteration #', fontsize=13)
+	plt.ylabel('Particle #', fontsize=13)
+	mat = plt.imshow(H,aspect='auto', interpolation="nearest", cmap=cmap, norm=norm)
+	#colorbar stuff
+	#labels[-1] = 'unassigned'
+	cb1 = plt.colorbar(mat, ticks=labels)
+	loc = labels + .5
+	#print loc
+	cb1.set_ticks(loc)
+	cb1.set_ticklabels(a)
+	cb1.ax.tick_params(labelsize=carpetfont)
+	cb1.set_label('Class #')
+	plt.xlim(2, iterations-0.5)
+
+
+	savepage(key)
 
 ### Plot heat map of the last 5 iterations (close-up)
-H = groupnumarraysorted[:,:]
-cmap = plt.get_cmap('jet', int(classes)+1)
-norm = matplotlib.colors.Normalize(vmin=0, vmax=int(classes)+1)
-plt.figure(num=None, dpi=120, facecolor='white')
-plt.title('Class assignments of each particle - last 5 iterations', fontsize=16, fontweight='bold')
-plt.xlabel('Iteration #', fontsize=13)
-plt.ylabel('Particle #', fontsize=13)
-mat = plt.imshow(H, aspect='auto', interpolation="nearest", cmap=cmap, norm=norm)
-#colorbar stuff
-labels = np.arange(0, classes+2)
-cb1 = plt.colorbar(mat, ticks=labels)
-loc = labels + .5
-cb1.set_ticks(loc)
-a[0]='no class'
-a[1:-1]=labels[1:-1]
-cb1.set_ticklabels(a)
-cb1.ax.tick_params(labelsize=16)
-cb1.set_label('Class #')
-plt.xlim(iterations-6.5, iterations-0.5)
-pdf.savefig()
-#plt.show()
+key = pagekey('carpetlast', carpet, a, labels, iterations)
+if not cachedpage(key):
+	H = carpet
+	cmap = carpetcmap
+	norm = carpetnorm
+	plt.figure(num=None, dpi=120, facecolor='white')
+	plt.title('Class assignments of each particle - last 5 iterations', fontsize=16, fontweight='bold')
+	plt.xlabel('Iteration #', fontsize=13)
+	plt.ylabel('Particle #', fontsize=13)
+	mat = plt.imshow(H, aspect='auto', interpolation="nearest", cmap=cmap, norm=norm)
+	#colorbar stuff
+	cb1 = plt.colorbar(mat, ticks=labels)
+	loc = labels + .5
+	cb1.set_ticks(loc)
+	cb1.set_ticklabels(a)
+	cb1.ax.tick_params(labelsize=carpetfont)
+	cb1.set_label('Class #')
+	plt.xlim(iterations-6.5, iterations-0.5)
+	savepage(key)
 
 #########################################################################################################################################################
 ### Sort group assignment array column by column
@@ -351,54 +1128,151 @@ for key, value in checkdict.iteritems():
 	checktest.append(hist)
 	labelsY.append(int(key))
 
-fig = plt.figure(num=None, dpi=80, facecolor='white')
-ax = fig.add_subplot(111)
-plt.title('Class assignment of each particle - last iteration', fontsize=16, fontweight='bold')
-plt.xlabel('Class assignment iteration %s'%(int(iterations)-2), fontsize=13)
-plt.ylabel('Class assignment iteration %s'%(int(iterations)-1), fontsize=13)
-plt.grid()
-ticks = np.arange(0, int(classes)+1)
-labelsX = np.arange(1, int(classes)+2)
-plt.xticks(ticks, labelsX)
-plt.yticks(ticks, labelsY)
-plt.imshow(checktest, aspect='auto', interpolation="nearest", origin='lower')	#FIXME values in box
-cb2 = plt.colorbar(ticks=np.arange(0, 1, 0.1))
-cb2.set_label('Fraction of particles went into group #')
-plt.figtext(0, 0, 'Particle class assignment changes in the last iteration')
-pdf.savefig()
-#plt.show()
+if largek != 'true':
+	key = pagekey('jumper', np.array(checktest), labelsY, classes, iterations)
+	if not cachedpage(key):
+		fig = plt.figure(num=None, dpi=80, facecolor='white')
+		ax = fig.add_subplot(111)
+		plt.title('Class assignment of each particle - last iteration', fontsize=16, fontweight='bold')
+		plt.xlabel('Class assignment iteration %s'%(int(iterations)-2), fontsize=13)
+		plt.ylabel('Class assignment iteration %s'%(int(iterations)-1), fontsize=13)
+		plt.grid()
+		ticks = np.arange(0, int(classes)+1)
+		labelsX = np.arange(1, int(classes)+2)
+		plt.xticks(ticks, labelsX)
+		plt.yticks(ticks, labelsY)
+		plt.imshow(checktest, aspect='auto', interpolation="nearest", origin='lower')	#FIXME values in box
+		cb2 = plt.colorbar(ticks=np.arange(0, 1, 0.1))
+		cb2.set_label('Fraction of particles went into group #')
+		plt.figtext(0, 0, 'Particle class assignment changes in the last iteration')
+		savepage(key)
+
+if largek == 'true' and len(transitions) > 0:	#Collapse the sparse transitions of the last iteration onto the largest classes
+	jumpmatrix = np.zeros((topn+2, topn+2), dtype=np.double)
+	np.add.at(jumpmatrix, (rankmap[transitions[-1][2]], rankmap[transitions[-1][1]]), transitions[-1][3])
+	jumpmatrix = jumpmatrix / np.maximum(jumpmatrix.sum(axis=1), 1)[:, None]
+	key = pagekey('jumpmatrix', jumpmatrix, ranklabels, iterations)
+	if not cachedpage(key):
+		fig = plt.figure(num=None, dpi=80, facecolor='white')
+		plt.title('Class assignment of each particle - last iteration', fontsize=16, fontweight='bold')
+		plt.xlabel('Class assignment iteration %s'%(int(iterations)-2), fontsize=13)
+		plt.ylabel('Class assignment iteration %s'%(int(iterations)-1), fontsize=13)
+		plt.xticks(np.arange(0, topn+2), ranklabels, fontsize=6, rotation=90)
+		plt.yticks(np.arange(0, topn+2), ranklabels, fontsize=6)
+		plt.imshow(jumpmatrix, aspect='auto', interpolation="nearest", origin='lower', vmin=0, vmax=1)
+		cb2 = plt.colorbar(ticks=np.arange(0, 1.1, 0.1))
+		cb2.set_label('Fraction of particles came from group #')
+		plt.figtext(0, 0, 'Particle class assignment changes in the last iteration (%s largest classes)'%topn)
+		savepage(key)
 
 ######################################################################################################################
 ###########################################################################
 #### Class assignments per micrograph of the last iteration
 
-### Convert dictionary to 2D array
-micval = []; micfirst = [];
-micticks = []
-for mics in micnumdict:
-	max_index, max_value = max(enumerate(micnumdict[mics][-1]), key=operator.itemgetter(1))
-	micval.append(micnumdict[mics][-1])
-	micticks.append(mics)
-
-### Sort last iter by most prominent group
-micval = np.array(micval)
-
-### Plot heat map last iteration
-cmap = plt.get_cmap('jet', np.max(micval)-np.min(micval)+1)
-plt.figure(num=None, dpi=80, facecolor='white')
-plt.title('Class assignments of each micrograph - last iteration', fontsize=16, fontweight='bold')
-plt.xlabel('Class #', fontsize=13)
-plt.ylabel('Micrograph #', fontsize=13)
+### Convert sparse counts of the last iteration to 2D array
+micval = np.zeros((len(micnames), int(classes)), dtype=int)
+if len(micocc) > 0:	#no counts before iteration 2
+	micval[micocc[-1][1], micocc[-1][2]] = micocc[-1][3]
+micticks = micnames
 ticks = np.arange(0, int(classes)+1)
 labels = np.arange(1, int(classes)+2)
-plt.xticks(ticks, labels)
-plt.grid()
-plt.imshow(micval, aspect='auto', interpolation="nearest", cmap=cmap)
-cb3 = plt.colorbar()
-cb3.set_label('Total number of particles in class #')
-plt.figtext(0, 0, 'Micrographs contributing to certain classes (e.g. important when merging datasets)')
-pdf.savefig()
-#plt.show()
+if largek == 'true':	#largest classes and one column for all other classes
+	micval = np.column_stack([micval[:, topclasses-1], micval.sum(axis=1) - micval[:, topclasses-1].sum(axis=1)])
+	ticks = np.arange(0, topn+1)
+	labels = ranklabels[1:]
+
+### Plot heat map last iteration
+key = pagekey('micrographs', micval, labels)
+if not cachedpage(key):
+	cmap = plt.get_cmap('jet', np.max(micval)-np.min(micval)+1)
+	plt.figure(num=None, dpi=80, facecolor='white')
+	plt.title('Class assignments of each micrograph - last iteration', fontsize=16, fontweight='bold')
+	plt.xlabel('Class #', fontsize=13)
+	plt.ylabel('Micrograph #', fontsize=13)
+	plt.xticks(ticks, labels)
+	plt.grid()
+	plt.imshow(micval, aspect='auto', interpolation="nearest", cmap=cmap)
+	cb3 = plt.colorbar()
+	cb3.set_label('Total number of particles in class #')
+	plt.figtext(0, 0, 'Micrographs contributing to certain classes (e.g. important when merging datasets)')
+	savepage(key)
+
+###### Spatial class occupancy of every micrograph from the particle coordinates of the last iteration
+if spatial == 'true' and ('_rlnCoordinateX' not in columnnames or '_rlnCoordinateY' not in columnnames):
+	print('No _rlnCoordinateX/_rlnCoordinateY columns found - skipping spatial analysis')
+	spatial = 'false'
+if spatial == 'true':
+	coordx = checkarray[:, columnnames.index('_rlnCoordinateX')]
+	coordy = checkarray[:, columnnames.index('_rlnCoordinateY')]
+	finalclass = groupnumarray[:, -1].astype(int)
+	spatialclasses = int(classes)
+	spatialnames = ['%s'%c for c in range(1, int(classes)+1)]
+	if largek == 'true':	#largest classes and one for all other classes
+		finalclass = rankmap[finalclass]
+		spatialclasses = topn+1
+		spatialnames = ranklabels[1:]
+	assigned = finalclass > 0
+	xbin = np.clip((coordx / max(coordx.max(), 1) * spatialbins).astype(int), 0, spatialbins-1)
+	ybin = np.clip((coordy / max(coordy.max(), 1) * spatialbins).astype(int), 0, spatialbins-1)
+
+	### One grouped bincount over (micrograph, class, y bin, x bin) for all particles
+	spatialcodes = ((micidx[assigned]*spatialclasses + finalclass[assigned]-1)*spatialbins + ybin[assigned])*spatialbins + xbin[assigned]
+	spatialcounts = np.bincount(spatialcodes, minlength=len(micnames)*spatialclasses*spatialbins**2).reshape(len(micnames), spatialclasses, spatialbins, spatialbins).astype(np.int32)
+
+	### Segregation score = Cramer's V of the class x spatial bin table of each micrograph (0 = classes mixed evenly)
+	table = spatialcounts.reshape(len(micnames), spatialclasses, -1).astype(np.double)
+	micparticles = table.sum(axis=(1, 2))
+	rowsum = table.sum(axis=2)
+	colsum = table.sum(axis=1)
+	expected = rowsum[:, :, None] * colsum[:, None, :] / np.maximum(micparticles, 1)[:, None, None]
+	chi2 = np.sum(np.where(expected > 0, (table - expected)**2 / np.where(expected > 0, expected, 1), 0), axis=(1, 2))
+	## Bias-corrected (Bergsma) so that micrographs with few particles do not look segregated by chance
+	nrow = (rowsum > 0).sum(axis=1).astype(np.double)
+	ncol = (colsum > 0).sum(axis=1).astype(np.double)
+	nm1 = np.maximum(micparticles - 1, 1)
+	phi2 = np.maximum(chi2 / np.maximum(micparticles, 1) - (nrow-1)*(ncol-1)/nm1, 0)
+	dof = np.minimum(nrow - (nrow-1)**2/nm1, ncol - (ncol-1)**2/nm1) - 1
+	segregation = np.where(dof > 0, np.sqrt(phi2 / np.where(dof > 0, dof, 1)), 0)
+	ranked = np.flatnonzero(micparticles >= spatialmin)
+	ranked = ranked[np.argsort(segregation[ranked], kind='mergesort')[::-1][:10]]
+	print('')
+	if len(ranked) == 0:
+		print('No micrograph has at least %s particles - no spatial segregation ranking'%spatialmin)
+	else:
+		print('Micrographs with the strongest spatial class segregation (at least %s particles):'%spatialmin)
+	for mi in ranked:
+		print('%s	score %.3f	%s particles'%(micnames[mi], segregation[mi], int(micparticles[mi])))
+
+	## Fraction of each class in every spatial bin, summed over all micrographs
+	key = pagekey('spatialmaps', spatialcounts.sum(axis=0), spatialnames)
+	if not cachedpage(key):
+		classmaps = spatialcounts.sum(axis=0).astype(np.double)
+		classmaps = classmaps / np.maximum(classmaps.sum(axis=0), 1)[None]
+		ncols = int(np.ceil(np.sqrt(spatialclasses)))
+		nrows = int(np.ceil(spatialclasses/float(ncols)))
+		fig, axes = plt.subplots(nrows, ncols, sharex=True, sharey=True, figsize=(11, 8.5), squeeze=False)
+		fig.suptitle('Fraction of particles per class across the micrograph area', fontsize=16, fontweight='bold')
+		for si, ax in enumerate(axes.ravel()):
+			if si >= spatialclasses:
+				ax.axis('off')
+				continue
+			im = ax.imshow(classmaps[si], interpolation='nearest', origin='lower', cmap='viridis')
+			ax.set_title('Class %s: %.2f-%.2f'%(spatialnames[si], classmaps[si].min(), classmaps[si].max()), fontsize=8)
+			ax.set_xticks([])
+			ax.set_yticks([])
+		savepage(key)
+
+	## Distribution of the segregation score
+	key = pagekey('segregation', segregation, micparticles, spatialbins, spatialmin)
+	if not cachedpage(key):
+		plt.figure(num=None, dpi=80, facecolor='white')
+		plt.title('Spatial class segregation per micrograph', fontsize=16, fontweight='bold')
+		plt.xlabel('Cramer\'s V of class vs. position (%sx%s bins)'%(spatialbins, spatialbins), fontsize=13)
+		plt.ylabel('# micrographs', fontsize=13)
+		plt.grid()
+		plt.hist(segregation[micparticles >= spatialmin], bins=30)
+		plt.figtext(0, 0, 'Micrographs with at least %s particles; high values can point to ice thickness gradients'%spatialmin)
+		savepage(key)
 
 ###### Find out how often particles are jumping
 scorelist = [];
@@ -420,97 +1294,191 @@ for g in groupnumarraysorted[:,2:]:
 				count = 0;
 
 	g = g.tolist()
-	counter = [[x,g.count(x)] for x in set(g)]
+	counter = [[gi,g.count(gi)] for gi in set(g)]
 	#score3 = (iterations-2)/float(len(counter))
-	score2 = (float(len(counter)))
-	score1 = (stayed/score2)/(iterations-2)
+	score2 = float(max(len(counter), 1))	#no iterations after it001 to count
+	score1 = (stayed/score2)/max(iterations-2, 1)
 	scorelist.append(score1)
 
-plt.figure(num=None, dpi=80, facecolor='white')
-plt.title('Particle jump score', fontsize=16, fontweight='bold')
-plt.xlabel('Score = (# class assignments/# of iterations)', fontsize=13)
-plt.ylabel('# of particles with score normalized', fontsize=13)
-plt.grid()
-#histbins = sorted(set(scorelist))
-histbins = np.arange(0, 0.5, 0.05)
-plt.hist(scorelist, bins=histbins, normed=True)
 mean1 = np.mean(scorelist)
 variance1 = np.var(scorelist)
 sigma1 = np.sqrt(variance1)
-#x1 = np.linspace(min(scorelist), max(scorelist), 100)
-x1 = np.linspace(0, 0.5, 100)
-plt.figtext(0, 0, 'Gaussian sigma: %s, variance: %s, mean: %s'%(sigma1, variance1, mean1))
-plt.plot(x1,mlab.normpdf(x1, mean1, sigma1))
-pdf.savefig()
+key = pagekey('jumpscore', np.array(scorelist))
+if not cachedpage(key):
+	plt.figure(num=None, dpi=80, facecolor='white')
+	plt.title('Particle jump score', fontsize=16, fontweight='bold')
+	plt.xlabel('Score = (# class assignments/# of iterations)', fontsize=13)
+	plt.ylabel('# of particles with score normalized', fontsize=13)
+	plt.grid()
+	#histbins = sorted(set(scorelist))
+	histbins = np.arange(0, 0.5, 0.05)
+	plt.hist(scorelist, bins=histbins, normed=True)
+	#x1 = np.linspace(min(scorelist), max(scorelist), 100)
+	x1 = np.linspace(0, 0.5, 100)
+	plt.figtext(0, 0, 'Gaussian sigma: %s, variance: %s, mean: %s'%(sigma1, variance1, mean1))
+	plt.plot(x1,mlab.normpdf(x1, mean1, sigma1))
+	savepage(key)
 
 ### Number of assignment changes per iteration
-plt.figure(num=None, dpi=80, facecolor='white')
-plt.title('Total assignment changes per iteration', fontsize=16, fontweight='bold')
-plt.xlabel('Iteration #', fontsize=13)
-plt.ylabel('# of changed assignments', fontsize=13)
-plt.grid()
-plt.plot(changes[2:])
-pdf.savefig()
-#plt.show()
+key = pagekey('changes', np.array(changes))
+if not cachedpage(key):
+	plt.figure(num=None, dpi=80, facecolor='white')
+	plt.title('Total assignment changes per iteration', fontsize=16, fontweight='bold')
+	plt.xlabel('Iteration #', fontsize=13)
+	plt.ylabel('# of changed assignments', fontsize=13)
+	plt.grid()
+	plt.plot(changes[2:])
+	savepage(key)
 
 #########################################################################################################################################################
-checkarraysorted = checkarray[sortindices]
-### Plot histogram of each column in data.star sorted by the class assignments of the last iteration
-histocolarray = collections.defaultdict(list)
-
-for column in checkarraysorted.transpose():
-	lastitgrouparray = collections.defaultdict(list)
-	for ci, col in enumerate(column):
-		lastitgrouparray[groupnumarraysorted[:,-1][ci]-1].append(col)
-		#print groupnumarraysorted[:,-1][ci]-1, ci, col
-	for key, value in lastitgrouparray.iteritems():
-		histocolarray[key].append(value)
-		#print key	#STILL has 0,3,4!!!
-
-
-fincolarray = collections.defaultdict(list)
-
-for key, value in histocolarray.iteritems():
-	for vi, v in enumerate(value):
-		#print key, vi, v					########### LOSING KEY
-		fincolarray[vi].append(v)
-
-for key2, value2 in fincolarray.iteritems():
-	rangeval = []; temp = []; #temp2 = [];
-
-	for vi2, v2 in enumerate(value2):
-		for v3 in v2:
-			rangeval.append(v3)
-
-	if len(set(rangeval)) > 1:
-	    for vi2, v2 in enumerate(value2):
-			temp.append(v2)
-
-	if len(temp) > 0:
-		plt.figure(num=None, dpi=120, facecolor='white')
-
-		if plottype == 'bar':
-			n, bins, patches = plt.hist(temp, range=(min(rangeval),max(rangeval)), histtype='bar')
-			cmap = plt.get_cmap('jet', classes+1)
-			colors = np.arange(0, classes+1)
-			for c, p in zip(colors, patches):
-				#d = c+1
-				d = int(histocolarray.keys()[c])+1		#recolor based on class HACK
-				plt.setp(p, 'facecolor', cmap(d))
-
-			#plt.colorbar(ticks=np.arange(1, int(classes)+1))
-		plt.title('Histogram Column %s'%checklistcol[int(key2)], fontsize=16, fontweight='bold')
-		plt.xlabel('%s'%checklistcol[int(key2)], fontsize=13)
-		plt.ylabel('# particles per bin', fontsize=13)
-		plt.grid()
-		pdf.savefig()
-		#plt.show()
+#### Association of every numeric column in data.star with the class assignment of the last iteration
+### Normalized mutual information between class and 10 rank (quantile) bins of each column, all columns in one bincount
+finalclass = groupnumarray[:, -1].astype(int)
+assoccols = [ci for ci in range(0, int(checklist[-1])+1) if not columnnames[ci].endswith('Name') and columnnames[ci] != '_rlnClassNumber' and np.min(checkarray[:, ci]) != np.max(checkarray[:, ci])]
+rankbins = 10
+values = checkarray[:, assoccols]
+valueorder = np.argsort(values, axis=0, kind='mergesort')
+sortedvalues = np.take_along_axis(values, valueorder, axis=0)
+firstofvalue = np.ones(sortedvalues.shape, dtype=bool)
+firstofvalue[1:] = sortedvalues[1:] != sortedvalues[:-1]
+minrank = np.maximum.accumulate(np.where(firstofvalue, np.arange(part)[:, None], 0), axis=0)	#ties share the lowest rank
+valuebins = np.empty(values.shape, dtype=int)
+np.put_along_axis(valuebins, valueorder, minrank * rankbins // part, axis=0)
+assoccodes = (np.arange(len(assoccols))*rankbins + valuebins)*(int(classes)+1) + finalclass[:, None]
+joint = np.bincount(assoccodes.ravel(), minlength=len(assoccols)*rankbins*(int(classes)+1)).reshape(len(assoccols), rankbins, int(classes)+1) / float(part)
+pbin = joint.sum(axis=2)
+pclass = joint.sum(axis=1)
+plogp = lambda p: np.where(p > 0, p * np.log(np.where(p > 0, p, 1)), 0)
+mutualinfo = np.sum(plogp(joint), axis=(1, 2)) - np.sum(plogp(pbin), axis=1) - np.sum(plogp(pclass), axis=1)
+association = mutualinfo / np.maximum(np.minimum(-np.sum(plogp(pbin), axis=1), -np.sum(plogp(pclass), axis=1)), 1e-12)
+assocrank = np.argsort(association)[::-1]
+print('')
+print('Association of each column with the final class (normalized mutual information):')
+for ai in assocrank:
+	print('%s	%.4f'%(columnnames[assoccols[ai]], association[ai]))
+
+## Ranked summary of all columns
+key = pagekey('association', association, [columnnames[ci] for ci in assoccols])
+if not cachedpage(key):
+	plt.figure(num=None, dpi=80, facecolor='white', figsize=(8, max(4, 0.25*len(assoccols))))
+	plt.title('Column association with final class', fontsize=16, fontweight='bold')
+	plt.xlabel('Normalized mutual information', fontsize=13)
+	plt.barh(np.arange(len(assoccols)), association[assocrank[::-1]], color='grey')
+	plt.yticks(np.arange(len(assoccols)), [columnnames[assoccols[ai]] for ai in assocrank[::-1]], fontsize=8)
+	plt.grid()
+	plt.tight_layout()
+	savepage(key)
 
-################################################################### DELETE UNWANTED PARTICLES FROM INITIAL STAR FILE ##FIXME
+### Plot histogram of the most associated columns sorted by the class assignments of the last iteration
+if topcols > 0:
+	histcols = [assoccols[ai] for ai in assocrank[:topcols]]
+else:
+	histcols = [assoccols[ai] for ai in assocrank]
 
-particcount = 0;
-initstarfile = '%s_it001_data.star'%(rootname)
-a1 = open('%s_filtered.star'%(rootname), 'w')
+if largek != 'true':
+	cmap = plt.get_cmap('jet', int(classes)+1)
+	classorder = np.argsort(finalclass, kind='mergesort')
+	classbounds = np.searchsorted(finalclass[classorder], np.arange(1, int(classes)+2))
+	for ci in histcols:
+		key = pagekey('histogram', columnnames[ci], checkarray[:, ci], finalclass, plottype, classes, association[assoccols.index(ci)])
+		if not cachedpage(key):
+			groups = np.split(checkarray[classorder, ci], classbounds)[1:-1]	#one array per class
+			filled = [c for c in range(int(classes)) if len(groups[c]) > 0]
+			if len(filled) == 0:	#no assignments yet
+				continue
+			plt.figure(num=None, dpi=120, facecolor='white')
+			plt.hist([groups[c] for c in filled], range=(np.min(checkarray[:, ci]), np.max(checkarray[:, ci])), histtype=plottype, color=[cmap(c+1) for c in filled], label=['Class %s'%(c+1) for c in filled])
+			plt.title('Histogram Column %s'%columnnames[ci], fontsize=16, fontweight='bold')
+			plt.xlabel('%s'%columnnames[ci], fontsize=13)
+			plt.ylabel('# particles per bin', fontsize=13)
+			plt.figtext(0, 0, 'Association with final class: %.4f'%association[assoccols.index(ci)])
+			plt.grid()
+			savepage(key)
+
+if largek == 'true':	#Stacked histograms of the largest classes, all other classes pooled
+	finalrank = rankmap[finalclass]
+	rankorder = np.argsort(finalrank, kind='mergesort')
+	rankbounds = np.searchsorted(finalrank[rankorder], np.arange(1, topn+3))
+	for ci in histcols:
+		column = checkarray[rankorder, ci]
+		key = pagekey('stackedhistogram', columnnames[ci], column, finalrank[rankorder], topn)
+		if not cachedpage(key):
+			groups = np.split(column, rankbounds)[1:-1]
+			plt.figure(num=None, dpi=120, facecolor='white')
+			plt.hist(groups, bins=30, range=(np.min(column), np.max(column)), histtype='barstacked', color=[rankcmap(ri) for ri in range(1, topn+2)])
+			plt.title('Histogram Column %s'%columnnames[ci], fontsize=16, fontweight='bold')
+			plt.xlabel('%s'%columnnames[ci], fontsize=13)
+			plt.ylabel('# particles per bin', fontsize=13)
+			plt.figtext(0, 0, 'Stacked by the %s largest classes, all other classes in grey'%topn)
+			plt.grid()
+			savepage(key)
+
+################################################################### EXPORT ARRAYS FOR OTHER PROGRAMS
+### Arrays are written straight from memory (no text conversion) and can be read back with np.load(..., mmap_mode='r')
+if export != '':
+	if not os.path.exists(export):
+		os.makedirs(export)
+	jumpscore = np.zeros(part, dtype=np.double)
+	jumpscore[sortindices] = scorelist	#scorelist follows the sorted carpet plot order
+	micoccupancy = np.zeros((0, 4), dtype=int)
+	if len(micocc) > 0:
+		micoccupancy = np.concatenate([np.column_stack([np.zeros(len(m[1]), dtype=int) + m[0], m[1], m[2], m[3]]) for m in micocc])
+	exported = collections.OrderedDict()
+	exported['assignments'] = groupnumarray
+	exported['jumpscore'] = jumpscore
+	exported['order'] = sortindices
+	exported['micrograph'] = micidx
+	if len(micoccupancy) > 0:
+		exported['micrograph_occupancy'] = micoccupancy	#(iteration, micrograph, class - 1, count) rows
+	exported['column_association'] = association	#same order as manifest 'association_columns'
+	if spatial == 'true':
+		exported['spatial_counts'] = spatialcounts	#(micrograph, class, y bin, x bin)
+		exported['spatial_segregation'] = segregation	#per micrograph
+	if angdist == 'true':
+		exported['orientation_counts'] = angcounts	#(iteration, class, rot bin, tilt bin)
+		exported['orientation_anisotropy'] = anisotropy	#(iteration, class - 1)
+	if maps == 'true':
+		exported['map_correlation'] = mapcorr	#(iteration, class - 1), with the previous iteration
+		exported['map_fsc_resolution'] = mapres	#(iteration, class - 1)
+	for ci in range(0, int(checklist[-1])+1):
+		if not columnnames[ci].endswith('Name'):	#file names are not kept in checkarray
+			exported['star%s'%columnnames[ci]] = checkarray[:, ci]
+	manifest = {'starfile': os.path.abspath('%s/%s'%(folder, iterationlist[-1])), 'particles': part, 'classes': int(classes), 'iterations': iterations, 'micrographs': micnames.tolist(), 'association_columns': [columnnames[ci] for ci in assoccols], 'format': exportfmt, 'arrays': {}}
+
+	if exportfmt == 'parquet':
+		try:
+			import pyarrow
+			import pyarrow.parquet
+		except ImportError:
+			print('pyarrow is not installed - exporting .npy files instead')
+			exportfmt = manifest['format'] = 'npy'
+	if exportfmt == 'parquet':	#contiguous arrays are wrapped as they are, the strided iteration and STAR columns are copied once
+		particles = collections.OrderedDict((key, value) for key, value in exported.items() if value.ndim == 1 and len(value) == part)
+		for it in range(iterations):
+			particles['it%03d'%it] = groupnumarray[:, it]
+		pyarrow.parquet.write_table(pyarrow.Table.from_arrays([pyarrow.array(v) for v in particles.values()], names=list(particles.keys())), '%s/particles.parquet'%export)
+		manifest['arrays'] = {'particles.parquet': list(particles.keys())}
+		if len(micoccupancy) > 0:
+			occupancy = pyarrow.Table.from_arrays([pyarrow.array(np.ascontiguousarray(micoccupancy[:, i])) for i in range(4)], names=['iteration', 'micrograph', 'class', 'count'])
+			pyarrow.parquet.write_table(occupancy, '%s/micrograph_occupancy.parquet'%export)
+			manifest['arrays']['micrograph_occupancy.parquet'] = ['iteration', 'micrograph', 'class', 'count']
+	for key, value in exported.items():	#all arrays for npy, those that are not one value per particle next to the parquet files
+		if exportfmt == 'npy' or (key not in particles and key not in ('assignments', 'micrograph_occupancy')):
+			np.save('%s/%s.npy'%(export, key), value)
+			manifest['arrays']['%s.npy'%key] = {'shape': list(value.shape), 'dtype': str(value.dtype)}
+	with open('%s/manifest.json'%export, 'w') as f:
+		json.dump(manifest, f, indent=1)
+	## Particle name index for --subset queries: sorted names and the row of each name
+	imagenames = np.array(imagelist)
+	imageorder = np.argsort(imagenames, kind='mergesort')
+	np.save('%s/imagename_index.npy'%export, imagenames[imageorder])
+	np.save('%s/imagename_rows.npy'%export, imageorder)
+	print('Exported %s arrays to %s'%(len(exported), export))
+
+################################################################### DELETE UNWANTED PARTICLES FROM INITIAL STAR FILE
+### Rows are selected with masks and copied through the byte-offset row index of the STAR file
+
+initstarfile = '%s/%s_it001_data.star'%(folder, rootname)
 if filtstar != 'false' or micfilt != '':
  ########################
  print('The mean jump score is: 					%s'%mean1)
@@ -520,32 +1488,37 @@ if filtstar != 'false' or micfilt != '':
  	print('I will use a cutoff of: 					%s'%(float(mean1)+(float(sigmafac)*float(sigma1))))
  cutoff = (float(mean1)+(float(sigmafac)*float(sigma1)))
 
- for i, score in enumerate(scorelist):
- 	if score > cutoff:
- 		unwanted.append(i)
+ keep = np.ones(part, dtype=bool)
+ if filtstar != 'false':
+ 	unwanted = sortindices[np.array(scorelist) > cutoff]	#scorelist follows the sorted carpet plot order
+ 	keep[unwanted] = False
+ if micfilt != '' and rescol != []:
+ 	keep &= checkarray[:, rescol] <= float(micfilt)
  ########################
- with open(initstarfile, 'rb') as g:
-   for m in g:
-	if '@' not in m:
-		a1.write(m)
-	if '@' in m:
-		if micfilt != '':
-			if float(m.split()[rescol]) <= float(micfilt):
-				a1.write(m)
-				#print('micfilt')
-		if filtstar != 'false':
-			if particcount not in unwanted:
-				a1.write(m)
-				#print('nomicfilt')
-		if filtstar != 'false' and micfilt != '':
-			if float(m.split()[rescol]) <= float(micfilt) and particcount not in unwanted:
-				a1.write(m)
-				#print('both')
-
-		particcount += 1;
- print('Saved %s_filtered.star file ommitting %s out of %s particles that changed classes too often'%(rootname, len(unwanted), particcount))
-a1.close()
-
-
+ kept = writestarrows(initstarfile, np.flatnonzero(keep), '%s_filtered.star'%(rootname))
+ print('Saved %s_filtered.star file ommitting %s out of %s particles that changed classes too often'%(rootname, len(unwanted), part))
+ if micfilt != '':
+ 	print('%s particles kept in total after the CTF resolution cutoff of %s'%(kept, micfilt))
+
+### One STAR file per class of the last iteration
+if splitstar == 'true':
+	laststarfile = '%s/%s'%(folder, iterationlist[-1])
+	finalclasses = groupnumarray[:, -1].astype(int)
+	classorder = np.argsort(finalclasses, kind='mergesort')
+	classbounds = np.searchsorted(finalclasses[classorder], np.arange(1, int(classes)+2))
+	for c in range(1, int(classes)+1):
+		rows = classorder[classbounds[c-1]:classbounds[c]]
+		if len(rows) > 0:
+			writestarrows(laststarfile, rows, '%s_class%03d.star'%(rootname, c))
+	print('Saved one STAR file per class as %s_classXXX.star'%rootname)
+
+
+if pagecache != '':
+	mergepages(pagefiles, output)
+	print('Reused %s of %s pages from %s'%(len(reusedpages), len(pagefiles), pagecache))
+if pagecache == '':
+	pdf.close()
 print('Saved all plots in %s'%output)
-pdf.close()
+
+if subset != '':
+	subsetquery(export, readimagenames(subset), '%s_subset.pdf'%output[:-4])
@@ -1,73 +1,759 @@
-from __future__ import division
-from sys import argv
-import math
+from __future__ import division, print_function
+import argparse
+import functools
+import glob
+import multiprocessing
+import os
+import re
+import sys
+import warnings
 import numpy as np
 
+# Chemical shift perturbations (CSPs) between Sparky peak lists.
+#
+#   python Sparky_CSP.py reference.list perturbed.list
+#
+# Each .list file is read once into an array of assignments and an array of
+# shifts (peaks x dimensions); the spectra are joined on the assignment and
+# the CSP of every residue is computed in one step:
+#
+#   CSP = sqrt( sum_i (w_i * delta_i**2) / ndim )
+#
+# With a 13C/1H list (w1 = 13C, w2 = 1H) this is sqrt(0.5*(dH**2 + 0.2*dC**2)).
+# The module can also be imported: read_list(), join_spectra(), csp().
+#
+# Titrations:
+#
+#   python Sparky_CSP.py --series titration.txt --protein 50
+#
+# The manifest lists one peak list per line with the ligand concentration and,
+# optionally, the protein concentration of that point (same units, e.g. uM);
+# the first line is the reference. All lists are aligned into one
+# (residues, points, ndim) array, the CSP trajectories are computed against the
+# reference and a binding isotherm is fitted to every residue at once, with
+# ligand depletion when the protein concentration is known.
+#
+# Screens, without prompts:
+#
+#   python Sparky_CSP.py --batch pairs.txt --out screen.txt
+#   python Sparky_CSP.py --batch lists/ --ref apo.list --out screen.txt
+#
+# The manifest has 'reference perturbed' (or only 'perturbed' with --ref) per
+# line, a folder is every .list in it against --ref. Each distinct file is
+# parsed once and all CSPs go into one table with a row per pair and residue.
+# With --processes both the parsing and the pairing/CSPs of the pairs run on a
+# process pool. Without --out the table is written next to the manifest
+# (pairs_csp.txt) or into the folder (csp.txt).
+#
+# Unassigned spectra: with --match the peaks are paired by minimal shift in
+# weighted ppm space (a KD-tree finds the neighbours within --cutoff, conflicts
+# are resolved by an optimal assignment, or greedily with --greedy) instead of
+# by assignment; '?-?' peaks are kept and named after their shifts.
+#
+# Significance: --significance sigma classifies the residues of every spectrum
+# against its mean and standard deviation after iteratively clipping the large
+# CSPs (--clip sigmas), --significance mad against the median and the scaled
+# median absolute deviation. Above centre + 2*scale a residue is significant,
+# above centre + 1*scale intermediate (--levels 1,2).
+#
+# Structures: --structure protein.pdb (or .cif) writes a copy of the structure
+# next to the output table with the CSP of every residue as B-factor (the
+# greatest CSP of its assignments, --missing elsewhere). CSPs are multiplied by
+# --bscale (default 100, so 0.05 ppm is a B-factor of 5.00) because B-factors
+# have two decimals and the typical 0.005-0.05 ppm would otherwise all round to
+# 0.00-0.05; PDB values are capped at 999.99 to fit the column. --residue is the regular
+# expression that finds the residue number (and optionally the chain) in an
+# assignment name. Hetero atoms are not painted. The structure is read once,
+# whatever the number of datasets.
+#
+# Fingerprints: --cluster 8 (or --distance 0.5) groups the perturbed spectra of a
+# batch by the residues they shift. The CSPs of every pair are aligned into a
+# (ligands, residues) matrix, the condensed pairwise distances (--metric) are
+# clustered hierarchically and the clusters are written next to the table.
 
-spec1 = open(argv[1])
-spec2 = open(argv[2])
-spec1data = {}
-spec2data = {}
-Cppm = {}
-Hppm = {}
-spectra_CSPs = {}
-CSP_values = []
+try:
+	input = raw_input	#python 2
+except NameError:
+	pass
 
-# Identifies the two .list files to calculate CSPs from.
-print "Loaded two spectra: %s and %s" % (argv[1], argv[2])
-name_of_file = raw_input("Output filename (will be automatically saved as .txt): ")
-output_file = open('/Users/student/nmr/nmrdata/CSP_data/'+name_of_file+'.txt', "w")
+# Weight of the shift difference of each nucleus relative to 1H
+WEIGHTS = {'1H': 1.0, '13C': 0.2, '15N': 0.14}
 
-output_file.write("Assignment\tCSP\n")
+# Significance classes, indexed by the levels of classify(); missing peaks are -1
+LEVELS = ('insignificant', 'intermediate', 'significant')
 
-for line in spec1:
-	line.replace('\n','')
-	data1 = line.split()
-	if data1 == [] or data1[0] == 'Assignment' or data1[0] == '?-?':
-		continue
+# Residue number of an assignment such as G12N-H or L45CD1-HD1, a 'chain' group is optional
+RESIDUE = r'^[A-Za-z]*?(?P<resnum>-?\d+)'
+
+# Folder of the interactive mode, used when no --out is given
+OUTPUT_DIR = '/Users/student/nmr/nmrdata/CSP_data/'
+
+
+def read_list(filename, unassigned=False):
+	# Returns the assignments (n) and the shifts (n, ndim) of a Sparky .list file.
+	# The number of dimensions comes from the w1, w2, ... columns of the header,
+	# further columns (heights, volumes) are ignored. Unassigned '?-?' peaks are
+	# skipped unless asked for, repeated assignments keep their first peak.
+	assignments = []
+	rows = []
+	ndim = None
+	with open(filename) as f:
+		for line in f:
+			data = line.split()
+			if data == []:
+				continue
+			if data[0] == 'Assignment':
+				ndim = len([d for d in data[1:] if d[0] == 'w' and d[1:].isdigit()])
+				continue
+			if ndim is None:
+				ndim = len(data) - 1
+			if data[0] == '?-?' and not unassigned:
+				continue
+			assignments.append(data[0])
+			rows.append(data[1:ndim+1])
+	assignments = np.array(assignments, dtype=str)
+	shifts = np.array(rows, dtype=float).reshape(len(rows), ndim or 0)
+	if not unassigned:
+		first = np.sort(np.unique(assignments, return_index=True)[1])
+		assignments, shifts = assignments[first], shifts[first]
+	return assignments, shifts
+
+
+def join_spectra(assign1, shifts1, assign2, shifts2, how='inner'):
+	# Aligns two spectra on their assignments, in the order of the first list.
+	# 'inner' keeps the assignments of both lists, 'outer' keeps all of them with
+	# NaN shifts where a peak is missing, 'left' keeps those of the first list.
+	if how == 'inner':
+		assignments = assign1[np.isin(assign1, assign2)]
+	elif how == 'outer':
+		assignments = np.concatenate([assign1, assign2[~np.isin(assign2, assign1)]])
+	elif how == 'left':
+		assignments = assign1
+	else:
+		raise ValueError("join must be 'inner', 'outer' or 'left', not %r" % how)
+	return (assignments,) + tuple(_align(assignments, a, s) for a, s in ((assign1, shifts1), (assign2, shifts2)))
+
+
+def join_series(spectra, how='inner'):
+	# Aligns a list of (assignments, shifts) pairs into one (residues, points, ndim)
+	# array, in the order of the first spectrum; joins as in join_spectra()
+	assignments = spectra[0][0]
+	for assign, shifts in spectra[1:]:
+		if how == 'inner':
+			assignments = assignments[np.isin(assignments, assign)]
+		elif how == 'outer':
+			assignments = np.concatenate([assignments, assign[~np.isin(assign, assignments)]])
+		elif how != 'left':
+			raise ValueError("join must be 'inner', 'outer' or 'left', not %r" % how)
+	return assignments, np.stack([_align(assignments, a, s) for a, s in spectra], axis=1)
+
+
+def _align(assignments, assign, shifts):
+	# Rows of shifts in the order of assignments, NaN for assignments not in assign
+	aligned = np.full((len(assignments), shifts.shape[1]), np.nan)
+	if len(assign) == 0:
+		return aligned
+	order = np.argsort(assign, kind='mergesort')
+	pos = np.clip(np.searchsorted(assign[order], assignments), 0, len(assign)-1)
+	found = assign[order][pos] == assignments
+	aligned[found] = shifts[order[pos[found]]]
+	return aligned
+
+
+def match_spectra(assign1, shifts1, assign2, shifts2, weights, cutoff=0.3, how='inner', neighbours=4, optimal=True):
+	# Pairs the peaks of two spectra by minimal shift instead of by assignment.
+	# Shifts are scaled so that the distance between two peaks is their CSP; a
+	# KD-tree of the second spectrum gives the nearest neighbours of every peak of
+	# the first within cutoff. Peaks competing for the same neighbour are resolved
+	# by a minimal-weight matching of this sparse graph (scipy >= 1.6), where
+	# leaving a peak unmatched costs the cutoff, or greedily by distance.
+	# Returns labels and aligned shifts like join_spectra().
+	from scipy.spatial import cKDTree
+	weights = np.asarray(weights, dtype=float)
+	scale = np.sqrt(weights / weights.size)
+	n1, n2 = len(shifts1), len(shifts2)
+	pair = np.full(n1, -1)
+	k = min(neighbours, n2)
+	if n1 and k:
+		dist, col = cKDTree(shifts2 * scale).query(shifts1 * scale, k=k, distance_upper_bound=cutoff)
+		dist, col = dist.reshape(n1, k), col.reshape(n1, k)
+		found = np.isfinite(dist)
+		row, col, dist = np.nonzero(found)[0], col[found], dist[found]
+		try:
+			from scipy.sparse import csr_matrix
+			from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+		except ImportError:
+			optimal = False
+		if optimal:
+			#each peak also has its own unmatched column, the tiny offset keeps zero distances as edges
+			graph = csr_matrix((np.concatenate([dist, np.full(n1, cutoff)]) + 1e-9, (np.concatenate([row, np.arange(n1)]), np.concatenate([col, n2 + np.arange(n1)]))), shape=(n1, n2 + n1))
+			matched = min_weight_full_bipartite_matching(graph)[1]
+			pair = np.where(matched < n2, matched, -1)
+		else:
+			used = np.zeros(n2, dtype=bool)
+			order = np.argsort(dist, kind='mergesort')
+			for r, c in zip(row[order], col[order]):
+				if pair[r] < 0 and not used[c]:
+					pair[r], used[c] = c, True
+	labels1, labels2 = _peak_labels(assign1, shifts1), _peak_labels(assign2, shifts2)
+	if how == 'inner':
+		keep = np.nonzero(pair >= 0)[0]
+	elif how in ('outer', 'left'):
+		keep = np.arange(n1)
+	else:
+		raise ValueError("join must be 'inner', 'outer' or 'left', not %r" % how)
+	aligned2 = np.full((len(keep), shifts1.shape[1]), np.nan)
+	aligned2[pair[keep] >= 0] = shifts2[pair[keep][pair[keep] >= 0]]
+	if how != 'outer':
+		return labels1[keep], shifts1[keep], aligned2
+	extra = np.setdiff1d(np.arange(n2), pair[pair >= 0])
+	return (np.concatenate([labels1, labels2[extra]]),
+		np.concatenate([shifts1, np.full((len(extra), shifts1.shape[1]), np.nan)]),
+		np.concatenate([aligned2, shifts2[extra]]))
+
+
+def _peak_labels(assign, shifts):
+	# Assignments, with unassigned peaks named after their shifts
+	labels = assign.astype(object)
+	for i in np.nonzero(assign == '?-?')[0]:
+		labels[i] = '?-?@' + ','.join('%.3f' % v for v in shifts[i])
+	return labels.astype(str)
+
+
+def pair_spectra(spectrum1, spectrum2, weights, how='inner', match=False, cutoff=0.3, optimal=True):
+	# Two (assignments, shifts) spectra aligned by assignment or, with match, by minimal shift
+	if match:
+		return match_spectra(spectrum1[0], spectrum1[1], spectrum2[0], spectrum2[1], weights, cutoff, how, optimal=optimal)
+	return join_spectra(spectrum1[0], spectrum1[1], spectrum2[0], spectrum2[1], how)
+
+
+def nucleus_weights(nuclei):
+	# Weights for a sequence of nuclei such as ('13C', '1H'), numbers are used as they are
+	return np.array([WEIGHTS[n] if n in WEIGHTS else float(n) for n in nuclei])
+
+
+def csp(shifts1, shifts2, weights):
+	# Weighted CSP of every row, NaN where a shift is missing
+	delta = np.asarray(shifts2, dtype=float) - np.asarray(shifts1, dtype=float)
+	weights = np.asarray(weights, dtype=float)
+	return np.sqrt(np.sum(weights * delta**2, axis=-1) / weights.size)
+
+
+def read_manifest(filename):
+	# Peak lists and concentrations of a titration: 'file ligand [protein]' per line,
+	# relative paths are taken from the folder of the manifest
+	folder = os.path.dirname(filename)
+	files, ligand, protein = [], [], []
+	with open(filename) as f:
+		for line in f:
+			data = line.split('#')[0].split()
+			if data == []:
+				continue
+			files.append(os.path.join(folder, data[0]))
+			ligand.append(float(data[1]))
+			protein.append(float(data[2]) if len(data) > 2 else np.nan)
+	return files, np.array(ligand), np.array(protein)
+
+
+def binding(ligand, protein, kd):
+	# Fraction of bound protein, broadcast over kd. With a protein concentration
+	# ligand depletion is taken into account (quadratic solution), without it
+	# (NaN or 0) the ligand is assumed to be in excess.
+	ligand, protein, kd = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in (ligand, protein, kd)])
+	simple = ligand / (kd + ligand)
+	depleted = np.isfinite(protein) & (protein > 0)
+	if not depleted.any():
+		return simple
+	p = np.where(depleted, protein, 1.0)
+	b = p + ligand + kd
+	quadratic = (b - np.sqrt(np.maximum(b**2 - 4*p*ligand, 0))) / (2*p)
+	return np.where(depleted, quadratic, simple)
+
+
+def _sse(y, mask, f):
+	# Residual sum of squares and the amplitude (delta max) of y = dmax * f, with dmax
+	# solved in closed form; y and mask are (residues, points), f broadcasts to them
+	# with a leading kd axis
+	yf = np.sum(y * f * mask, axis=-1)
+	ff = np.sum(f * f * mask, axis=-1)
+	dmax = yf / np.where(ff > 0, ff, np.inf)
+	return np.sum(y * y * mask, axis=-1) - dmax * yf, dmax
+
+
+def fit_kd(csps, ligand, protein=np.nan, grid=200, refine=40):
+	# Fits csp = dmax * bound(ligand, protein, kd) to every residue (rows of csps,
+	# NaN for missing peaks). A log-spaced kd grid is scanned for all residues in
+	# one step and the best kd of each residue is refined by a golden section search
+	# between its neighbouring grid points. Returns kd, dmax and the rmsd per residue.
+	csps = np.atleast_2d(np.asarray(csps, dtype=float))
+	mask = np.isfinite(csps).astype(float)
+	y = np.where(mask > 0, csps, 0.0)
+	ligand = np.asarray(ligand, dtype=float)
+	protein = np.broadcast_to(np.asarray(protein, dtype=float), ligand.shape)
+	positive = ligand[ligand > 0]
+	kds = np.logspace(np.log10(positive.min()) - 2, np.log10(positive.max()) + 2, grid)
+	f = binding(ligand[None, :], protein[None, :], kds[:, None])	#(grid, points)
+	sse = _sse(y[:, None, :], mask[:, None, :], f[None, :, :])[0]	#(residues, grid)
+	best = np.argmin(sse, axis=1)
+	step = np.log(kds[1] / kds[0])
+	lo, hi = np.log(kds[best]) - step, np.log(kds[best]) + step
+	golden = (np.sqrt(5) - 1) / 2
+
+	def cost(logkd):
+		return _sse(y, mask, binding(ligand[None, :], protein[None, :], np.exp(logkd)[:, None]))[0]
+
+	a, b = hi - golden*(hi - lo), lo + golden*(hi - lo)
+	fa, fb = cost(a), cost(b)
+	for i in range(refine):
+		left = fa < fb	#minimum between lo and b
+		hi, lo = np.where(left, b, hi), np.where(left, lo, a)
+		a, b = np.where(left, hi - golden*(hi - lo), b), np.where(left, a, lo + golden*(hi - lo))
+		fnew = cost(np.where(left, a, b))
+		fa, fb = np.where(left, fnew, fb), np.where(left, fa, fnew)
+	kd = np.exp((lo + hi) / 2)
+	sse, dmax = _sse(y, mask, binding(ligand[None, :], protein[None, :], kd[:, None]))
+	rmsd = np.sqrt(np.maximum(sse, 0) / np.maximum(mask.sum(axis=1), 1))
+	return kd, dmax, rmsd
+
+
+def _fit_chunk(job):
+	return fit_kd(*job)
+
+
+def fit_kd_parallel(csps, ligand, protein=np.nan, processes=1, chunk=500):
+	# fit_kd() over a process pool, residues are split into chunks
+	csps = np.atleast_2d(csps)
+	if processes <= 1 or len(csps) <= chunk:
+		return fit_kd(csps, ligand, protein)
+	pool = multiprocessing.Pool(processes)
+	try:
+		parts = pool.map(_fit_chunk, [(csps[i:i+chunk], ligand, protein) for i in range(0, len(csps), chunk)])
+	finally:
+		pool.close()
+	return tuple(np.concatenate(p) for p in zip(*parts))
+
+
+def titration(manifest, nuclei=('13C', '1H'), how='inner', protein=np.nan, processes=1):
+	# Assignments, CSP trajectories (residues, points) against the first point,
+	# ligand concentrations and the fitted kd, dmax and rmsd of a titration manifest
+	files, ligand, protein_points = read_manifest(manifest)
+	protein_points = np.where(np.isnan(protein_points), protein, protein_points)
+	assignments, shifts = join_series([read_list(f) for f in files], how)
+	if shifts.shape[2] != len(nuclei):
+		raise ValueError('%s has %s dimensions but %s nuclei were given' % (files[0], shifts.shape[2], len(nuclei)))
+	csps = csp(shifts[:, :1], shifts, nucleus_weights(nuclei))
+	return (assignments, csps, ligand) + fit_kd_parallel(csps, ligand, protein_points, processes)
+
+
+def read_lists(files, processes=1, unassigned=False):
+	# Parses every distinct file once: {filename: (assignments, shifts)}
+	unique = sorted(set(files))
+	reader = functools.partial(read_list, unassigned=unassigned)
+	if processes > 1 and len(unique) > 1:
+		pool = multiprocessing.Pool(processes)
+		try:
+			parsed = pool.map(reader, unique)
+		finally:
+			pool.close()
+	else:
+		parsed = [reader(f) for f in unique]
+	return dict(zip(unique, parsed))
+
+
+def read_pairs(source, reference=None):
+	# (reference, perturbed) pairs from a manifest with 'reference perturbed' or
+	# 'perturbed' per line, or from a folder of .list files compared to reference.
+	# Relative paths of a manifest are taken from its folder.
+	if os.path.isdir(source):
+		if reference is None:
+			raise ValueError('a reference .list file (--ref) is needed for the folder %s' % source)
+		files = sorted(glob.glob(os.path.join(source, '*.list')))
+		return [(reference, f) for f in files if os.path.abspath(f) != os.path.abspath(reference)]
+	folder = os.path.dirname(source)
+	pairs = []
+	with open(source) as f:
+		for line in f:
+			data = [os.path.join(folder, d) for d in line.split('#')[0].split()]
+			if data == []:
+				continue
+			if len(data) == 1:
+				if reference is None:
+					raise ValueError('no reference for %s in %s, give one on the line or with --ref' % (data[0], source))
+				data.insert(0, reference)
+			pairs.append((data[0], data[1]))
+	return pairs
+
+
+_batch_state = {}
+
+
+def _init_batch(cache, weights, how, match, cutoff, optimal):
+	# Parsed lists and options of a batch, set once per worker process
+	_batch_state.update(cache=cache, options=(weights, how, match, cutoff, optimal))
+
+
+def _batch_pair(pair):
+	reference, perturbed = pair
+	cache, (weights, how, match, cutoff, optimal) = _batch_state['cache'], _batch_state['options']
+	assignments, shifts1, shifts2 = pair_spectra(cache[reference], cache[perturbed], weights, how, match, cutoff, optimal)
+	return reference, perturbed, assignments, csp(shifts1, shifts2, weights)
+
+
+def batch(pairs, nuclei=('13C', '1H'), how='inner', processes=1, match=False, cutoff=0.3, optimal=True):
+	# Yields reference, perturbed, assignments and CSPs of every pair, in order;
+	# the files are parsed once and shared between the pairs, and both the
+	# parsing and the pairs run over a process pool
+	cache = read_lists([f for pair in pairs for f in pair], processes, unassigned=match)
+	for filename, (assignments, shifts) in cache.items():
+		if shifts.shape[1] != len(nuclei):
+			raise ValueError('%s has %s dimensions but %s nuclei were given' % (filename, shifts.shape[1], len(nuclei)))
+	state = (cache, nucleus_weights(nuclei), how, match, cutoff, optimal)
+	if processes > 1 and len(pairs) > 1:
+		pool = multiprocessing.Pool(processes, _init_batch, state)
+		try:
+			for result in pool.imap(_batch_pair, pairs, chunksize=max(1, len(pairs) // (4 * processes))):
+				yield result
+		finally:
+			pool.close()
 	else:
-		spec1data[data1[0]] = float(data1[1]), float(data1[2])
+		_init_batch(*state)
+		for pair in pairs:
+			yield _batch_pair(pair)
+
+
+def write_batch(filename, results, levels=None):
+	# One table for all pairs: a row per pair and assignment, levels has a row per pair
+	with open(filename, 'w') as output_file:
+		output_file.write("Reference\tPerturbed\tAssignment\tCSP%s\n" % ('' if levels is None else '\tSignificance'))
+		for ri, (reference, perturbed, assignments, csps) in enumerate(results):
+			for ci, (perturb, obs_CSP) in enumerate(zip(assignments, csps)):
+				level = '' if levels is None else '\t' + _level_name(levels[ri][ci])
+				output_file.write("%s\t%s\t%s\t%r%s\n" % (reference, perturbed, perturb, float(obs_CSP), level))
+
+
+def write_series(filename, assignments, csps, ligand, kd, dmax, rmsd):
+	# One row per residue: the fit followed by the CSP of every titration point
+	with open(filename, 'w') as output_file:
+		output_file.write("Assignment	Kd	CSPmax	RMSD	%s\n" % '\t'.join('%g' % l for l in ligand))
+		for row in zip(assignments, kd, dmax, rmsd, csps):
+			output_file.write("%s \t%.4g\t%.4g\t%.4g\t%s\n" % (row[:4] + ('\t'.join('%.5f' % c for c in row[4]),)))
+
+
+def compare(list1, list2, nuclei=('13C', '1H'), how='inner', match=False, cutoff=0.3, optimal=True):
+	# Assignments and CSPs between two .list files
+	spectrum1, spectrum2 = read_list(list1, match), read_list(list2, match)
+	if spectrum1[1].shape[1] != len(nuclei):
+		raise ValueError('%s has %s dimensions but %s nuclei were given' % (list1, spectrum1[1].shape[1], len(nuclei)))
+	weights = nucleus_weights(nuclei)
+	assignments, shifts1, shifts2 = pair_spectra(spectrum1, spectrum2, weights, how, match, cutoff, optimal)
+	return assignments, csp(shifts1, shifts2, weights)
+
+
+def write_table(filename, assignments, csps, levels=None):
+	with open(filename, 'w') as output_file:
+		if levels is None:
+			output_file.write("Assignment\tCSP\n")
+			for perturb, obs_CSP in zip(assignments, csps):
+				output_file.write("%s \t%r\n" % (perturb, float(obs_CSP)))
+			return
+		output_file.write("Assignment\tCSP\tSignificance\n")
+		for perturb, obs_CSP, level in zip(assignments, csps, levels):
+			output_file.write("%s \t%r\t%s\n" % (perturb, float(obs_CSP), _level_name(level)))
+
+
+def _level_name(level):
+	return LEVELS[level] if level >= 0 else 'missing'
+
+
+def summary(csps):
+	# Mean, standard deviation and greatest CSP, missing peaks are left out
+	csps = np.asarray(csps, dtype=float)
+	csps = csps[~np.isnan(csps)]
+	return np.mean(csps), np.std(csps, ddof=1), np.max(csps)
+
+
+def output_name(args):
+	if args.out:
+		return args.out
+	name_of_file = input("Output filename (will be automatically saved as .txt): ")
+	return OUTPUT_DIR + name_of_file + '.txt'
+
+
+def residue_csps(assignments, csps, rule=RESIDUE):
+	# Lookup of the greatest CSP of every residue: {(chain, number): CSP}, where the
+	# chain is None unless the rule has a 'chain' group
+	pattern = re.compile(rule)
+	lookup = {}
+	for perturb, obs_CSP in zip(assignments, csps):
+		found = pattern.match(perturb)
+		if found is None or not np.isfinite(obs_CSP):
+			continue
+		key = (found.groupdict().get('chain'), int(found.group('resnum')))
+		lookup[key] = max(lookup.get(key, -np.inf), float(obs_CSP))
+	return lookup
+
+
+def paint_structures(structure, outputs, missing=0.0, chain=None, scale=100.0):
+	# Streams a PDB or mmCIF file once and writes a copy to every (filename, lookup)
+	# of outputs with the residue CSPs of the lookup times scale as B-factors. Atoms
+	# of chains other than chain, if given, get the missing value (not scaled).
+	cif = structure.lower().endswith(('.cif', '.mmcif'))
+	files = [open(filename, 'w') for filename, lookup in outputs]
+	lookups = [lookup for filename, lookup in outputs]
+	token = re.compile(r"'[^']*'|\"[^\"]*\"|\S+")
+	columns, layout, residue, values = [], None, None, None
+	try:
+		with open(structure) as f:
+			for line in f:
+				if cif:
+					if line.startswith('loop_'):
+						columns, layout = [], None
+					elif line.startswith('_atom_site.'):
+						columns.append(line.split()[0])
+					elif line.startswith(('ATOM', 'HETATM')) and columns:
+						if layout is None:	#chain, residue number and B-factor columns
+							layout = [columns.index(c) if c in columns else None for c in (
+								'_atom_site.auth_asym_id' if '_atom_site.auth_asym_id' in columns else '_atom_site.label_asym_id',
+								'_atom_site.auth_seq_id' if '_atom_site.auth_seq_id' in columns else '_atom_site.label_seq_id',
+								'_atom_site.B_iso_or_equiv')]
+						fields = token.findall(line)
+						key = (fields[layout[0]] if layout[0] is not None else None, fields[layout[1]] if fields[0] == 'ATOM' else None)
+						bfactor = layout[2]
+						if key != residue:
+							residue, values = key, _residue_values(lookups, key[0], key[1], missing, chain, scale)
+						for out, value in zip(files, values):
+							fields[bfactor] = '%.2f' % value
+							out.write(' '.join(fields) + '\n')
+						continue
+				elif line.startswith(('ATOM  ', 'HETATM')):
+					key = (line[21], line[22:26] if line.startswith('ATOM') else None)
+					if key != residue:
+						residue, values = key, _residue_values(lookups, key[0], key[1], missing, chain, scale)
+					for out, value in zip(files, values):
+						out.write('%s%6.2f%s' % (line[:60], min(value, 999.99), line[66:]))
+					continue
+				for out in files:
+					out.write(line)
+	finally:
+		for out in files:
+			out.close()
+
+
+def _residue_values(lookups, chain_id, resnum, missing, chain, scale=1.0):
+	# B-factor of a residue in every lookup, hetero atoms (resnum None) are not painted
+	try:
+		resnum = int(resnum)
+	except (TypeError, ValueError):
+		return [missing] * len(lookups)
+	if chain is not None and chain_id != chain:
+		return [missing] * len(lookups)
+	values = [lookup.get((chain_id, resnum), lookup.get((None, resnum))) for lookup in lookups]
+	return [missing if value is None else value * scale for value in values]
+
+
+def structure_name(structure, table, dataset=None):
+	# Painted copy of a structure next to an output table, one per dataset of a batch
+	base = os.path.splitext(table)[0]
+	if dataset is not None:
+		base += '_' + os.path.splitext(os.path.basename(dataset))[0]
+	return base + os.path.splitext(structure)[1]
 
-for line in spec2:
-	line.replace('\n','')
-	data2 = line.split()
-	if data2 == [] or data2[0] == 'Assignment' or data1[0] == '?-?':
-		continue
+
+def fingerprints(results):
+	# Assignments and (pairs, assignments) CSP matrix of batch results, aligned on
+	# all assignments in order of appearance; missing peaks count as no shift
+	everything = np.concatenate([r[2] for r in results])
+	labels = everything[np.sort(np.unique(everything, return_index=True)[1])]
+	order = np.argsort(labels)
+	matrix = np.zeros((len(results), len(labels)))
+	for ri, (reference, perturbed, assignments, csps) in enumerate(results):
+		matrix[ri, order[np.searchsorted(labels[order], assignments)]] = np.where(np.isfinite(csps), csps, 0.0)
+	return labels, matrix
+
+
+def cluster_fingerprints(matrix, clusters=None, distance=None, metric='correlation', method='average'):
+	# Cluster number of every row of matrix from a hierarchical clustering of the
+	# condensed distances between rows, cut into clusters or at distance.
+	# Returns the cluster numbers and the condensed distances.
+	from scipy.cluster.hierarchy import fcluster, linkage
+	from scipy.spatial.distance import pdist
+	if len(matrix) < 2:
+		return np.ones(len(matrix), dtype=int), np.zeros(0)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		distances = pdist(matrix, metric)
+	#rows without any shift have no correlation or direction, count them as unrelated
+	distances[~np.isfinite(distances)] = 1.0 if metric in ('correlation', 'cosine') else np.nanmax(np.where(np.isfinite(distances), distances, np.nan))
+	tree = linkage(distances, method)
+	if clusters:
+		return fcluster(tree, clusters, 'maxclust'), distances
+	return fcluster(tree, distance, 'distance'), distances
+
+
+def write_clusters(filename, results, labels, matrix, cluster, top=5):
+	# Cluster and most shifted assignments of every pair
+	with open(filename, 'w') as output_file:
+		output_file.write("Reference\tPerturbed\tCluster\tLargest CSPs\n")
+		for (reference, perturbed, assignments, csps), number, row in zip(results, cluster, matrix):
+			output_file.write("%s\t%s\t%s\t%s\n" % (reference, perturbed, number, ','.join(labels[np.argsort(row, kind='mergesort')[::-1][:top]])))
+
+
+def clipped_stats(csps, nsigma=3.0, iterations=20):
+	# Mean and standard deviation of every row of csps (NaN for missing values)
+	# after iteratively leaving out the values above mean + nsigma*std
+	csps = np.atleast_2d(np.asarray(csps, dtype=float))
+	keep = np.isfinite(csps)
+	values = np.where(keep, csps, 0.0)
+	for i in range(iterations):
+		n = keep.sum(axis=1)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			mean = np.sum(values * keep, axis=1) / n
+			std = np.sqrt(np.sum((values - mean[:, None])**2 * keep, axis=1) / (n - 1))
+			clipped = keep & (values <= (mean + nsigma*std)[:, None])
+		if (clipped == keep).all():
+			break
+		keep = clipped
+	return mean, std
+
+
+def mad_stats(csps):
+	# Median and median absolute deviation, scaled to a standard deviation, of every row
+	csps = np.atleast_2d(np.asarray(csps, dtype=float))
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', RuntimeWarning)	#spectra without any peak in common
+		median = np.nanmedian(csps, axis=1)
+		return median, 1.4826 * np.nanmedian(np.abs(csps - median[:, None]), axis=1)
+
+
+def classify(csps, method='sigma', levels=(1, 2), nsigma=3.0):
+	# Significance level of every value of csps (rows are spectra): 2 above
+	# centre + levels[1]*scale, 1 above centre + levels[0]*scale, 0 below and -1
+	# where missing. Returns the levels and the two thresholds of every row.
+	csps = np.atleast_2d(np.asarray(csps, dtype=float))
+	if method == 'sigma':
+		centre, scale = clipped_stats(csps, nsigma)
+	elif method == 'mad':
+		centre, scale = mad_stats(csps)
 	else:
-		spec2data[data2[0]] = float(data2[1]), float(data2[2])
-		
-#print spec1data, spec2data
-
-for res in spec1data:
-	Cppm[res] = spec1data[res][0], spec2data[res][0]
-	Hppm[res] = spec1data[res][1], spec2data[res][1]
-
-for perturb in Cppm:
-	delC = float(Cppm[perturb][1]) - float(Cppm[perturb][0])
-	delH = float(Hppm[perturb][1]) - float(Hppm[perturb][0])
-	obs_CSP = math.sqrt(0.5*((delH**2)+(0.2*(delC**2))))
-	spectra_CSPs[perturb] = obs_CSP
-	CSP_values.append(obs_CSP)
-	#mk_str = str(obs_CSP)
-	line_to_write = "%s \t%r\n" % (perturb, obs_CSP)
-	output_file.write(line_to_write)
-
-# Find greatest CSP value observed:
-greatest_CSP = max(CSP_values)
-
-# Calculate standard deviation of the observed CSPs.
-mean_CSP = np.mean(CSP_values)
-sum_sq_dist = 0
-
-for value in CSP_values:
-	dist_from_mean = (value - mean_CSP)**2
-	sum_sq_dist = sum_sq_dist + dist_from_mean
-
-std_dev = math.sqrt(float(1/(len(CSP_values)-1))*sum_sq_dist)
-print "The mean and standard deviation for this dataset is: %r and %r" % (mean_CSP, std_dev)
-print "The greatest observed CSP is: %r" % greatest_CSP
-
-
-spec1.close()
-spec2.close()
-output_file.close()
\ No newline at end of file
+		raise ValueError("method must be 'sigma' or 'mad', not %r" % method)
+	lower, upper = centre + levels[0]*scale, centre + levels[1]*scale
+	with np.errstate(invalid='ignore'):
+		level = (csps > lower[:, None]).astype(int) + (csps > upper[:, None])
+	level[~np.isfinite(csps)] = -1
+	return level, lower, upper
+
+
+def _padded(rows):
+	# Rows of different lengths as one NaN padded array
+	table = np.full((len(rows), max([len(r) for r in rows] + [0])), np.nan)
+	for ri, r in enumerate(rows):
+		table[ri, :len(r)] = r
+	return table
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Chemical shift perturbations between two Sparky peak lists')
+	parser.add_argument('spectra', nargs='*', help='reference and perturbed .list files')
+	parser.add_argument('--nuclei', default='13C,1H', help="nucleus of each dimension, w1 first, or a weight (default: 13C,1H)")
+	parser.add_argument('--join', default='inner', choices=['inner', 'outer', 'left'], help='assignments to report (default: inner, those in both lists)')
+	parser.add_argument('--series', metavar='MANIFEST', help="titration: lines of 'file ligand [protein]', the first one is the reference")
+	parser.add_argument('--protein', type=float, default=np.nan, help='protein concentration of the titration points without one, for ligand depletion')
+	parser.add_argument('--batch', metavar='MANIFEST|FOLDER', help="pairs of 'reference perturbed' .list files per line, or a folder of .list files")
+	parser.add_argument('--ref', help='reference .list file of a folder, or of manifest lines with one file')
+	parser.add_argument('--out', help='output table, instead of asking for a name in %s (default with --batch: next to the manifest or in the folder)' % OUTPUT_DIR)
+	parser.add_argument('--match', action='store_true', help='pair peaks by minimal shift instead of by assignment, for unassigned spectra')
+	parser.add_argument('--cutoff', type=float, default=0.3, help='largest CSP of a matched pair of peaks (default: 0.3)')
+	parser.add_argument('--greedy', action='store_true', help='resolve matching conflicts greedily by distance instead of optimally')
+	parser.add_argument('--significance', choices=['sigma', 'mad'], help='classify residues by iteratively sigma-clipped statistics or by the median absolute deviation')
+	parser.add_argument('--levels', default='1,2', help='intermediate and significant thresholds in standard deviations above the centre (default: 1,2)')
+	parser.add_argument('--clip', type=float, default=3.0, help='sigmas above the mean that are clipped when estimating the statistics (default: 3)')
+	parser.add_argument('--structure', help='PDB or mmCIF file to copy with the CSPs as B-factors')
+	parser.add_argument('--residue', default=RESIDUE, help='regular expression with a resnum (and optionally a chain) group for the assignments (default: %s)' % RESIDUE.replace('%', '%%'))
+	parser.add_argument('--chain', help='only paint this chain of the structure')
+	parser.add_argument('--missing', type=float, default=0.0, help='B-factor of residues without a CSP (default: 0)')
+	parser.add_argument('--bscale', type=float, default=100.0, help='factor from CSP (ppm) to B-factor (default: 100)')
+	parser.add_argument('--cluster', type=int, help='group the spectra of a batch into this many CSP fingerprint clusters')
+	parser.add_argument('--distance', type=float, help='group the spectra of a batch into fingerprint clusters cut at this distance')
+	parser.add_argument('--metric', default='correlation', help='distance between fingerprints, any scipy pdist metric (default: correlation)')
+	parser.add_argument('--processes', type=int, default=1, help='processes for reading and pairing the lists of a batch and for the Kd fits (default: 1)')
+	args = parser.parse_args(argv)
+	if args.series:
+		return main_series(args)
+	if args.batch:
+		return main_batch(args)
+	if len(args.spectra) != 2:
+		parser.error('two .list files are needed, or --series or --batch')
+
+	# Identifies the two .list files to calculate CSPs from.
+	print("Loaded two spectra: %s and %s" % tuple(args.spectra))
+	assignments, csps = compare(args.spectra[0], args.spectra[1], args.nuclei.split(','), args.join, args.match, args.cutoff, not args.greedy)
+	levels = None
+	if args.significance:
+		levels, lower, upper = classify(csps, args.significance, [float(l) for l in args.levels.split(',')], args.clip)
+		levels = levels[0]
+	filename = output_name(args)
+	write_table(filename, assignments, csps, levels)
+	if args.structure:
+		paint_structures(args.structure, [(structure_name(args.structure, filename), residue_csps(assignments, csps, args.residue))], args.missing, args.chain, args.bscale)
+
+	missing = np.isnan(csps).sum()
+	if missing:
+		print("%s assignments are missing from one of the spectra" % missing)
+	mean_CSP, std_dev, greatest_CSP = summary(csps)
+	print("The mean and standard deviation for this dataset is: %r and %r" % (float(mean_CSP), float(std_dev)))
+	print("The greatest observed CSP is: %r" % float(greatest_CSP))
+	if args.significance:
+		print("Intermediate above %.4f, significant above %.4f: %s significant and %s intermediate residues" % (lower[0], upper[0], (levels == 2).sum(), (levels == 1).sum()))
+
+
+def main_series(args):
+	print("Loaded titration: %s" % args.series)
+	assignments, csps, ligand, kd, dmax, rmsd = titration(args.series, args.nuclei.split(','), args.join, args.protein, args.processes)
+	filename = output_name(args)
+	write_series(filename, assignments, csps, ligand, kd, dmax, rmsd)
+	if args.structure:	#fitted CSP at saturation
+		paint_structures(args.structure, [(structure_name(args.structure, filename), residue_csps(assignments, dmax, args.residue))], args.missing, args.chain, args.bscale)
+	print("%s residues over %s titration points" % csps.shape)
+	fitted = np.isfinite(kd) & (dmax > 0)
+	print("The median Kd of the residues with the largest 10%% CSPs is: %r" % float(np.median(kd[fitted & (dmax >= np.percentile(dmax[fitted], 90))])))
+
+
+def batch_name(args):
+	# Output table of a batch without prompting: --out, or next to the inputs
+	if args.out:
+		return args.out
+	if os.path.isdir(args.batch):
+		return os.path.join(args.batch, 'csp.txt')
+	return os.path.splitext(args.batch)[0] + '_csp.txt'
+
+def main_batch(args):
+	pairs = read_pairs(args.batch, args.ref)
+	print("Loaded %s pairs of spectra from %s" % (len(pairs), args.batch))
+	filename = batch_name(args)
+	results = []
+	for reference, perturbed, assignments, csps in batch(pairs, args.nuclei.split(','), args.join, args.processes, args.match, args.cutoff, not args.greedy):
+		results.append((reference, perturbed, assignments, csps))
+		if np.isfinite(csps).sum() > 1:
+			mean_CSP, std_dev, greatest_CSP = summary(csps)
+			print("%s: %s assignments, mean %.4f, standard deviation %.4f, greatest %.4f" % (perturbed, len(csps), mean_CSP, std_dev, greatest_CSP))
+		else:
+			print("%s: no assignments in common with %s" % (perturbed, reference))
+	levels = None
+	if args.significance:
+		levels, lower, upper = classify(_padded([r[3] for r in results]), args.significance, [float(l) for l in args.levels.split(',')], args.clip)
+		for (reference, perturbed, assignments, csps), level in zip(results, levels):
+			print("%s: %s significant, %s intermediate" % (perturbed, (level == 2).sum(), (level == 1).sum()))
+	write_batch(filename, results, levels)
+	if args.cluster or args.distance is not None:
+		labels, matrix = fingerprints(results)
+		cluster = cluster_fingerprints(matrix, args.cluster, args.distance, args.metric)[0]
+		write_clusters(os.path.splitext(filename)[0] + '_clusters.txt', results, labels, matrix, cluster)
+		for number in np.unique(cluster):
+			members = cluster == number
+			print("Cluster %s: %s spectra, most shifted %s" % (number, members.sum(), ', '.join(labels[np.argsort(matrix[members].mean(axis=0), kind='mergesort')[::-1][:5]])))
+	if args.structure:
+		paint_structures(args.structure, [(structure_name(args.structure, filename, perturbed), residue_csps(assignments, csps, args.residue)) for reference, perturbed, assignments, csps in results], args.missing, args.chain, args.bscale)
+	print("Saved the CSPs of all pairs in %s" % filename)
+
+
+if __name__ == '__main__':
+	sys.exit(main())
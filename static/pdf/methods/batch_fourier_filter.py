@@ -0,0 +1,129 @@
+"""Apply the filters of fourier_filter.py to whole datasets of MRC files.
+
+    python batch_fourier_filter.py Micrographs/ --out Filtered/ --filter lowpass --param cutoff=0.1
+    python batch_fourier_filter.py particles.mrcs --out Filtered/ --filter gaussian --param decay=50
+
+Every input (.mrc micrographs or .mrcs particle stacks, files or folders) is
+memory-mapped and filtered a chunk of sections at a time on several threads,
+and several files are filtered at once, so folders of single micrographs keep
+all cores busy as well as large particle stacks; the output is a float32 MRC file of the same shape that is allocated up front
+and written in place through a memory map, so memory use is bounded by the
+chunk size and the number of threads, not by the size of the dataset.
+
+Very large micrographs can be filtered in tiles with overlapping margins
+instead of with one FFT per micrograph:
+
+    python batch_fourier_filter.py Micrographs/ --out Filtered/ --filter blur --param sigma=4 --tile 1024
+
+The margins default to the width that holds all but 1e-3 of the real-space
+response of the filter. That is a few pixels for blur, but can be the whole
+micrograph for filters with long tails (gaussian, lowpass), which are then
+filtered whole with a warning; --margin sets a narrower one, at the cost of a
+difference from filtering the whole micrograph.
+"""
+
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import fourier_filter
+import mrc_io
+
+
+def input_files(paths):
+    """MRC files of the arguments, folders are searched for .mrc and .mrcs files."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, '*.mrc')) + glob.glob(os.path.join(path, '*.mrcs')))
+        else:
+            files.append(path)
+    return files
+
+
+def filter_file(path, outpath, filt, chunk=16, threads=None, tile=None, margin=None):
+    """Filter every section of the MRC file path into outpath; returns the number of sections.
+
+    filt is either a filter on the rfft2 grid of the sections or a function of
+    the section (or tile) shape that returns one. With tile, every section is
+    filtered in tiles by fourier_filter.filter_tiled(), with margins of
+    fourier_filter.response_radius() unless margin is given. Threads left over
+    when there are fewer chunks than threads run the FFTs of each chunk.
+    """
+    data, voxel = mrc_io.read_mrc(path)
+    out = mrc_io.create_mrc(outpath, data.shape, voxel)
+    threads = threads or os.cpu_count()
+    stats = mrc_io.RunningStats()
+    if tile:
+        # the margin is checked once per file instead of once per section
+        if margin is None:
+            margin = fourier_filter.response_radius(filt, min(max(data.shape[1:]), 4096))
+        else:
+            fourier_filter.check_margin(filt, margin, data.shape)
+        for section in range(len(data)):
+            fourier_filter.filter_tiled(data[section], filt, tile, margin, out=out[section], batch=threads, workers=threads, tolerance=None)
+            stats.add(out[section])
+    else:
+        if callable(filt):
+            filt = filt(data.shape)
+        chunks = -(-len(data) // chunk)
+        workers = max(1, threads // chunks)
+
+        def work(start):
+            stop = min(start + chunk, len(data))
+            out[start:stop] = fourier_filter.apply_filter(data[start:stop], filt, workers=workers)
+            return start, stop
+
+        with ThreadPoolExecutor(min(threads, chunks)) as pool:
+            for start, stop in pool.map(work, range(0, len(data), chunk)):
+                stats.add(out[start:stop])
+    out.flush()
+    mrc_io.update_stats(outpath, *stats.result())
+    return len(data)
+
+
+def parse_params(params):
+    """{'decay': 100.0} from ['decay=100']"""
+    parsed = {}
+    for param in params:
+        name, value = param.split('=', 1)
+        parsed[name] = float(value)
+    return parsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fourier filter MRC micrographs and particle stacks')
+    parser.add_argument('inputs', nargs='+', help='.mrc/.mrcs files or folders')
+    parser.add_argument('--out', required=True, help='output folder')
+    parser.add_argument('--filter', default='gaussian', choices=sorted(fourier_filter.KERNELS), help='filter (default: gaussian)')
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE', help='filter parameter, e.g. decay=100 or cutoff=0.05; can be repeated')
+    parser.add_argument('--chunk', type=int, default=16, help='sections filtered at a time per thread (default: 16)')
+    parser.add_argument('--tile', type=int, default=None, help='filter each section in tiles of this size (default: whole sections)')
+    parser.add_argument('--margin', type=int, default=None, help='pixels around each tile (default: the width of the real-space response of the filter)')
+    parser.add_argument('--threads', type=int, default=None, help='threads (default: all cores)')
+    args = parser.parse_args(argv)
+
+    params = parse_params(args.param)
+    files = input_files(args.inputs)
+    os.makedirs(args.out, exist_ok=True)
+    outpaths = [os.path.join(args.out, os.path.basename(path)) for path in files]
+    for path, outpath in zip(files, outpaths):
+        if os.path.abspath(outpath) == os.path.abspath(path):
+            sys.exit('%s would be overwritten, choose another output folder' % path)
+    # files in parallel, the threads of each file share the rest of the cores
+    threads = args.threads or os.cpu_count()
+    parallel = max(1, min(threads, len(files)))
+
+    def work(paths):
+        path, outpath = paths
+        return filter_file(path, outpath, lambda shape: fourier_filter.make_filter(shape, args.filter, **params), args.chunk, max(1, threads // parallel), args.tile, args.margin)
+
+    with ThreadPoolExecutor(parallel) as pool:
+        for path, outpath, sections in zip(files, outpaths, pool.map(work, zip(files, outpaths))):
+            print('%s: %s sections filtered into %s' % (path, sections, outpath))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""CTF-corrected previews of the micrographs or particles of a RELION STAR file.
+
+    python ctf_filter.py micrographs_ctf.star --out Corrected/ --mode phaseflip
+    python ctf_filter.py particles.star --out Corrected/ --mode wiener --snr 0.1
+
+The CTF of every micrograph or particle is built from its _rlnDefocusU/V/Angle
+(and _rlnPhaseShift) and from the voltage, spherical aberration, amplitude
+contrast and pixel size of its optics group. CTFs are computed for a batch of
+images at once on the cached frequency grids of fourier_filter.py and applied
+as a phase flip, a multiplication by the CTF or a Wiener filter. Outputs are
+float32 MRC files with the names of the inputs, written through memory maps.
+"""
+
+import argparse
+import functools
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import fourier_filter
+import mrc_io
+
+
+def read_star(path):
+    """Return the blocks of a STAR file as {block name: {column: array of strings}}.
+
+    Only loops are read, which is where RELION keeps its tables; for example
+    read_star('particles.star')['particles']['_rlnDefocusU'].
+    """
+    blocks = OrderedDict()
+    name, columns, rows, looping = None, [], [], False
+
+    def close():
+        if name is not None and columns:
+            table = np.array(rows, dtype=str).reshape(len(rows), len(columns))
+            blocks[name] = OrderedDict((column, table[:, ci]) for ci, column in enumerate(columns))
+
+    with open(path) as f:
+        for line in f:
+            data = line.split()
+            if not data or data[0].startswith('#'):
+                continue
+            if data[0].startswith('data_'):
+                close()
+                name, columns, rows, looping = data[0][5:], [], [], False
+            elif data[0] == 'loop_':
+                looping = True
+            elif data[0].startswith('_'):
+                if looping and not rows:  # key-value pairs are not tables
+                    columns.append(data[0])
+            elif columns and len(data) >= len(columns):
+                rows.append(data[:len(columns)])
+    close()
+    return blocks
+
+
+def star_images(path):
+    """Images of a STAR file with their CTF parameters.
+
+    Returns the table (particles or micrographs) as a dict of arrays with the
+    optics group values (voltage, Cs, amplitude contrast, pixel size) filled in
+    for every row; older files without an optics block need these columns in
+    the table itself.
+    """
+    blocks = read_star(path)
+    tables = [b for b in blocks if b != 'optics']
+    if not tables:
+        raise ValueError('%s has no table of images' % path)
+    table = blocks[tables[0]]
+    rows = len(next(iter(table.values())))
+    if 'optics' in blocks:
+        optics = blocks['optics']
+        group = table.get('_rlnOpticsGroup', np.full(rows, optics['_rlnOpticsGroup'][0]))
+        position = {g: i for i, g in enumerate(optics['_rlnOpticsGroup'])}
+        index = np.array([position[g] for g in group])
+        for column, values in optics.items():
+            if column not in table:
+                table[column] = values[index]
+    return table
+
+
+def column(table, names, default=None):
+    """First of the columns names in table as floats, or default."""
+    for name in names:
+        if name in table:
+            return table[name].astype(np.float64)
+    if default is None:
+        raise KeyError('none of the columns %s' % ', '.join(names))
+    return np.full(len(next(iter(table.values()))), default)
+
+
+def wavelength(voltage):
+    """Relativistic electron wavelength in A for an acceleration voltage in kV."""
+    volts = np.asarray(voltage, dtype=np.float64) * 1e3
+    return 12.2643247 / np.sqrt(volts * (1 + 0.978466e-6 * volts))
+
+
+@functools.lru_cache(maxsize=32)
+def polar_grids(shape):
+    """Squared spatial frequency (cycles/pixel) and its angle on the rfft2 grid of shape, cached."""
+    ky, kx, k = fourier_filter.frequency_grids(shape)
+    k2 = (k**2).astype(np.float32)
+    angle = np.arctan2(ky, kx).astype(np.float32)
+    for grid in (k2, angle):
+        grid.setflags(write=False)
+    return k2, angle
+
+
+def ctf(shape, defocus_u, defocus_v, angle, voltage, cs, amplitude, pixel, phase_shift=0.0):
+    """CTFs of a batch of images: (n, ny, nx//2 + 1) float32 on the rfft2 grid of shape.
+
+    Every parameter is an array with a value per image (or a scalar): defocus
+    in A, astigmatism angle and phase shift in degrees, voltage in kV, Cs in
+    mm, amplitude contrast as a fraction and pixel size in A.
+    """
+    k2, theta = polar_grids(tuple(shape[-2:]))
+    per_image = [np.asarray(p, dtype=np.float64).reshape(-1, 1, 1) for p in
+                 (defocus_u, defocus_v, angle, voltage, cs, amplitude, pixel, phase_shift)]
+    defocus_u, defocus_v, angle, voltage, cs, amplitude, pixel, phase_shift = per_image
+    lam = wavelength(voltage)
+    s2 = k2 / pixel**2  # 1/A**2
+    defocus = 0.5 * (defocus_u + defocus_v + (defocus_u - defocus_v) * np.cos(2 * (theta - np.radians(angle))))
+    # CTFFIND convention, RELION has the opposite global sign and the same zeros
+    chi = (np.pi * lam * defocus * s2 - 0.5 * np.pi * cs * 1e7 * lam**3 * s2**2
+           + np.radians(phase_shift) + np.arctan(amplitude / np.sqrt(1 - amplitude**2)))
+    return (-np.sin(chi)).astype(np.float32)
+
+
+def correction(ctfs, mode='phaseflip', snr=0.1):
+    """Filters that correct a batch of CTFs: 'phaseflip', 'ctf' (multiply) or 'wiener'."""
+    if mode == 'phaseflip':
+        return np.sign(ctfs)
+    if mode == 'ctf':
+        return ctfs
+    if mode == 'wiener':
+        return ctfs / (ctfs**2 + 1.0 / snr)
+    raise ValueError("mode must be 'phaseflip', 'ctf' or 'wiener', not %r" % mode)
+
+
+def ctf_parameters(table):
+    """(8, rows) array of the ctf() parameters of every row of a star_images() table."""
+    return np.array([
+        column(table, ['_rlnDefocusU']),
+        column(table, ['_rlnDefocusV']),
+        column(table, ['_rlnDefocusAngle'], 0.0),
+        column(table, ['_rlnVoltage']),
+        column(table, ['_rlnSphericalAberration']),
+        column(table, ['_rlnAmplitudeContrast'], 0.1),
+        column(table, ['_rlnImagePixelSize', '_rlnMicrographPixelSize', '_rlnPixelSize', '_rlnDetectorPixelSize']),
+        column(table, ['_rlnPhaseShift'], 0.0)])
+
+
+def correct_star(path, out, mode='phaseflip', snr=0.1, root='.', chunk=16, workers=None):
+    """Write CTF-corrected copies of the images of a STAR file into the folder out.
+
+    Particles (_rlnImageName, NNNNNN@stack.mrcs) are corrected stack by stack,
+    sections without a row keep their values; micrographs (_rlnMicrographName)
+    are corrected in batches of chunk micrographs of the same shape. Returns
+    the number of images.
+    """
+    table = star_images(path)
+    parameters = ctf_parameters(table)
+    os.makedirs(out, exist_ok=True)
+    if '_rlnImageName' in table:
+        names = table['_rlnImageName']
+        sections = np.array([int(n.split('@')[0]) - 1 for n in names])
+        files = np.array([n.split('@')[1] for n in names])
+        for filename in np.unique(files):
+            rows = np.nonzero(files == filename)[0]
+            data, voxel = mrc_io.read_mrc(os.path.join(root, filename))
+            outpath = os.path.join(out, os.path.basename(filename))
+            result = mrc_io.create_mrc(outpath, data.shape, voxel)
+            result[:] = data  # sections without CTF parameters
+            for start in range(0, len(rows), chunk):
+                batch = rows[start:start + chunk]
+                filters = correction(ctf(data.shape, *parameters[:, batch]), mode, snr)
+                result[sections[batch]] = fourier_filter.apply_filter(data[sections[batch]], filters, workers)
+            mrc_io.finish_mrc(outpath, result, chunk)
+        return len(names)
+    files = table['_rlnMicrographName']
+    shapes = OrderedDict()
+    for row, filename in enumerate(files):
+        shapes.setdefault(mrc_io.read_header(os.path.join(root, filename))[2::-1], []).append(row)
+    for shape, rows in shapes.items():
+        for start in range(0, len(rows), chunk):
+            batch = rows[start:start + chunk]
+            micrographs = [mrc_io.read_mrc(os.path.join(root, files[row])) for row in batch]
+            filters = correction(ctf(shape, *parameters[:, batch]), mode, snr)
+            filtered = fourier_filter.apply_filter(np.stack([data[0] for data, voxel in micrographs]), filters, workers)
+            for row, (data, voxel), image in zip(batch, micrographs, filtered):
+                mrc_io.write_mrc(os.path.join(out, os.path.basename(files[row])), image[None], voxel)
+    return len(files)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CTF-corrected copies of the micrographs or particles of a STAR file')
+    parser.add_argument('star', help='micrographs or particles STAR file with CTF parameters')
+    parser.add_argument('--out', required=True, help='output folder')
+    parser.add_argument('--mode', default='phaseflip', choices=['phaseflip', 'ctf', 'wiener'], help='correction (default: phaseflip)')
+    parser.add_argument('--snr', type=float, default=0.1, help='signal to noise ratio of the Wiener filter (default: 0.1)')
+    parser.add_argument('--root', default='.', help='RELION project folder the image names are relative to (default: current folder)')
+    parser.add_argument('--chunk', type=int, default=16, help='images corrected at a time (default: 16)')
+    parser.add_argument('--threads', type=int, default=None, help='FFT threads (default: all cores)')
+    args = parser.parse_args(argv)
+    done = correct_star(args.star, args.out, args.mode, args.snr, args.root, args.chunk, args.threads or os.cpu_count())
+    print('%s images corrected into %s' % (done, args.out))
+
+
+if __name__ == '__main__':
+    main()
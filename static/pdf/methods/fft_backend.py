@@ -0,0 +1,262 @@
+"""Real FFTs through numpy.fft, scipy.fft or pyFFTW, whichever is fastest here.
+
+    import fft_backend
+    spectrum = fft_backend.rfftn(images, axes=(-2, -1))
+    images = fft_backend.irfftn(spectrum, s=images.shape[-2:], axes=(-2, -1))
+
+The backend is chosen, in order, by set_backend(), the FFT_BACKEND environment
+variable, the preference file written by the benchmark, or scipy when it is
+installed (numpy otherwise):
+
+    python fft_backend.py benchmark --shape 4096x4096 --shape 256x256 --batch 16
+    python fft_backend.py show
+
+numpy.fft and scipy.fft cache their plans internally. pyFFTW plans are built
+once per shape, dtype, axes and thread count and kept (per thread, since a
+plan owns its arrays); the FFTW wisdom gathered while planning is saved to
+disk when the program exits and loaded again by the next run, so the slow
+FFTW_MEASURE planning is paid once per machine. Single precision input gives
+single precision output with every backend.
+"""
+
+import argparse
+import atexit
+import json
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+PREFERENCE_FILE = os.environ.get('FFT_BACKEND_CONFIG', os.path.expanduser('~/.config/fft_backend.json'))
+WISDOM_FILE = os.environ.get('FFTW_WISDOM', os.path.expanduser('~/.cache/fft_backend/fftw_wisdom.pickle'))
+
+COMPLEX = {np.dtype(np.float32): np.complex64, np.dtype(np.float64): np.complex128}
+
+
+class NumpyBackend:
+    """numpy.fft, one thread."""
+
+    name = 'numpy'
+
+    def __init__(self):
+        self.fft = np.fft
+
+    def rfftn(self, a, s=None, axes=None, workers=1):
+        return self.fft.rfftn(a, s=s, axes=axes)
+
+    def irfftn(self, a, s=None, axes=None, workers=1):
+        return self.fft.irfftn(a, s=s, axes=axes)
+
+
+class ScipyBackend(NumpyBackend):
+    """scipy.fft, which keeps single precision and runs on `workers` threads."""
+
+    name = 'scipy'
+
+    def __init__(self):
+        import scipy.fft
+        self.fft = scipy.fft
+
+    def rfftn(self, a, s=None, axes=None, workers=1):
+        return self.fft.rfftn(a, s=s, axes=axes, workers=workers)
+
+    def irfftn(self, a, s=None, axes=None, workers=1):
+        return self.fft.irfftn(a, s=s, axes=axes, workers=workers)
+
+
+class FFTWBackend:
+    """pyFFTW builders with a cache of plans and persistent wisdom."""
+
+    name = 'pyfftw'
+
+    def __init__(self, effort='FFTW_MEASURE', plans=32):
+        import pyfftw
+        import pyfftw.builders
+        self.pyfftw = pyfftw
+        self.effort = effort
+        self.plans = plans
+        self._local = threading.local()
+        self._planned = False
+        if os.path.exists(WISDOM_FILE):
+            with open(WISDOM_FILE, 'rb') as f:
+                pyfftw.import_wisdom(pickle.load(f))
+        atexit.register(self.save_wisdom)
+
+    def _plan(self, kind, a, s, axes, workers):
+        cache = self._local.__dict__.setdefault('plans', OrderedDict())
+        key = (kind, a.shape, a.dtype.str, None if s is None else tuple(s), None if axes is None else tuple(axes), workers)
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        # plan on a scratch array, FFTW_MEASURE overwrites the input while planning
+        scratch = self.pyfftw.empty_aligned(a.shape, dtype=a.dtype)
+        builder = getattr(self.pyfftw.builders, kind)
+        plan = builder(scratch, s=s, axes=axes, threads=workers, planner_effort=self.effort)
+        self._planned = True
+        cache[key] = plan
+        while len(cache) > self.plans:
+            cache.popitem(last=False)
+        return plan
+
+    def rfftn(self, a, s=None, axes=None, workers=1):
+        # the output array belongs to the plan and is overwritten by the next call
+        return self._plan('rfftn', a, s, axes, workers)(a).copy()
+
+    def irfftn(self, a, s=None, axes=None, workers=1):
+        return self._plan('irfftn', a, s, axes, workers)(a).copy()
+
+    def save_wisdom(self):
+        """Write the FFTW wisdom to WISDOM_FILE if new plans were made."""
+        if not self._planned:
+            return
+        os.makedirs(os.path.dirname(WISDOM_FILE), exist_ok=True)
+        with open(WISDOM_FILE, 'wb') as f:
+            pickle.dump(self.pyfftw.export_wisdom(), f)
+        self._planned = False
+
+
+BACKENDS = OrderedDict([
+    ('numpy', NumpyBackend),
+    ('scipy', ScipyBackend),
+    ('pyfftw', FFTWBackend),
+])
+
+_backends = {}
+_current = {}
+
+
+def available():
+    """Names of the backends that can be imported here."""
+    names = []
+    for name in BACKENDS:
+        try:
+            backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def backend(name):
+    """The backend `name`, created once."""
+    if name not in BACKENDS:
+        raise ValueError('unknown FFT backend %r, choose from %s' % (name, ', '.join(BACKENDS)))
+    if name not in _backends:
+        _backends[name] = BACKENDS[name]()
+    return _backends[name]
+
+
+def read_preference(path=PREFERENCE_FILE):
+    """{'backend': name, 'workers': n, ...} written by the benchmark, or {} without a file."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def set_backend(name, workers=None):
+    """Use backend `name` (with `workers` threads by default) from now on."""
+    _current['backend'] = backend(name)
+    _current['workers'] = workers or 1
+
+
+def current():
+    """Return the backend in use and its default number of threads."""
+    if 'backend' not in _current:
+        preference = read_preference()
+        name = os.environ.get('FFT_BACKEND') or preference.get('backend')
+        if name is None:
+            name = 'scipy' if 'scipy' in available() else 'numpy'
+        set_backend(name, preference.get('workers') if name == preference.get('backend') else None)
+    return _current['backend'], _current['workers']
+
+
+def rfftn(a, s=None, axes=None, workers=None):
+    """Real FFT over axes (default all) with the current backend; float32 gives complex64."""
+    a = np.asarray(a)
+    if a.dtype not in COMPLEX:
+        a = a.astype(np.float64)
+    fft, default = current()
+    return fft.rfftn(a, s=s, axes=axes, workers=workers or default).astype(COMPLEX[a.dtype], copy=False)
+
+
+def irfftn(a, s=None, axes=None, workers=None):
+    """Inverse of rfftn() back to real values of shape s (on axes); complex64 gives float32."""
+    a = np.asarray(a)
+    real = np.float32 if a.dtype == np.complex64 else np.float64
+    if a.dtype not in (np.complex64, np.complex128):
+        a = a.astype(np.complex128)
+    fft, default = current()
+    return fft.irfftn(a, s=s, axes=axes, workers=workers or default).astype(real, copy=False)
+
+
+def benchmark(shapes, batch=1, repeats=5, workers=None, names=None):
+    """Time a forward and inverse float32 rfftn of a batch of every shape with each backend and thread count.
+
+    Returns {(backend, workers): seconds summed over the shapes}, each shape
+    timed as the best of `repeats` runs after one run that builds the plans.
+    numpy.fft is only timed with one thread.
+    """
+    workers = workers or sorted({1, max(1, (os.cpu_count() or 1) // 2), os.cpu_count() or 1})
+    names = names or available()
+    data = [np.random.default_rng(0).random((batch,) + tuple(shape), dtype=np.float32) for shape in shapes]
+    timings = OrderedDict()
+    for name in names:
+        fft = backend(name)
+        for threads in ([1] if name == 'numpy' else workers):
+            total = 0.0
+            for images in data:
+                axes = tuple(range(1, images.ndim))
+                fft.irfftn(fft.rfftn(images, axes=axes, workers=threads), s=images.shape[1:], axes=axes, workers=threads)
+                best = np.inf
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    fft.irfftn(fft.rfftn(images, axes=axes, workers=threads), s=images.shape[1:], axes=axes, workers=threads)
+                    best = min(best, time.perf_counter() - start)
+                total += best
+            timings[name, threads] = total
+    return timings
+
+
+def parse_shape(text):
+    """(4096, 4096) from '4096x4096', a single number is a square."""
+    shape = tuple(int(n) for n in text.lower().split('x'))
+    return shape * 2 if len(shape) == 1 else shape
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Choose the fastest FFT backend and thread count for this machine')
+    commands = parser.add_subparsers(dest='command', required=True)
+    bench = commands.add_parser('benchmark', help='time the backends and save the fastest to the preference file')
+    bench.add_argument('--shape', action='append', type=parse_shape, metavar='NYxNX', help='image (or NZxNYxNX volume) shape, can be repeated (default: 4096x4096 and 256x256)')
+    bench.add_argument('--batch', type=int, default=1, help='images transformed together (default: 1)')
+    bench.add_argument('--repeats', type=int, default=5, help='runs per shape, the best is kept (default: 5)')
+    bench.add_argument('--threads', type=int, action='append', help='thread count to try, can be repeated (default: 1, half and all cores)')
+    bench.add_argument('--out', default=PREFERENCE_FILE, help='preference file (default: %s)' % PREFERENCE_FILE)
+    commands.add_parser('show', help='print the available backends and the one in use')
+    args = parser.parse_args(argv)
+
+    if args.command == 'show':
+        fft, workers = current()
+        print('available: %s' % ', '.join(available()))
+        print('in use: %s with %s thread(s)' % (fft.name, workers))
+        print('preference file: %s' % PREFERENCE_FILE)
+        return
+
+    shapes = args.shape or [(4096, 4096), (256, 256)]
+    timings = benchmark(shapes, args.batch, args.repeats, args.threads)
+    for (name, threads), seconds in timings.items():
+        print('%-8s %3s thread(s) %10.2f ms' % (name, threads, seconds * 1e3))
+    name, threads = min(timings, key=timings.get)
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump({'backend': name, 'workers': threads, 'shapes': shapes, 'batch': args.batch,
+                   'timings': {'%s/%s' % key: seconds for key, seconds in timings.items()}}, f, indent=2)
+    print('fastest: %s with %s thread(s), saved in %s' % (name, threads, args.out))
+
+
+if __name__ == '__main__':
+    main()
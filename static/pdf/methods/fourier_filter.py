@@ -0,0 +1,293 @@
+"""Linear Fourier filters of images and image stacks.
+
+The filters of linear_fourier_filter_exercise.py as a module:
+
+    import fourier_filter as ff
+    filtered = ff.filter_image(image, 'gaussian', decay=100)
+    filtered = ff.filter_image(stack, 'lowpass', cutoff=.05)   # (n, ny, nx)
+
+Images are transformed with a real FFT (rfft2/irfft2) in single precision, so
+only the half-plane of non-negative x frequencies is stored. Frequencies are in
+cycles per pixel, from 0 to 0.5 along each axis, and the frequency grids and
+filters of each image shape are computed once and cached. The transforms run
+on the backend chosen by fft_backend.py (numpy, scipy or pyFFTW).
+
+Images too large to transform at once are filtered tile by tile, with margins
+wide enough for the real-space response of the filter. Only filters with a
+compact response, like blur, keep those margins (and the memory) small; the
+long tails of gaussian and lowpass need margins as wide as the image:
+
+    filtered = ff.filter_tiled(micrograph, 'blur', tile=1024, sigma=4)
+
+To try many filters on the same image, a FilterSession transforms it once and
+only runs the inverse FFT for each new filter:
+
+    session = ff.FilterSession(image)
+    for decay, filtered in session.sweep('gaussian', 'decay', [10, 50, 100, 200]):
+        ...
+"""
+
+import functools
+import hashlib
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
+import fft_backend
+
+
+@functools.lru_cache(maxsize=32)
+def frequency_grids(shape):
+    """Return ky, kx and k = sqrt(kx**2 + ky**2) of the rfft2 of an image shape.
+
+    ky is a column and kx a row (broadcastable), k is the full
+    (ny, nx//2 + 1) half-plane grid. The arrays are cached and read-only.
+    """
+    ny, nx = shape[-2:]
+    ky = np.fft.fftfreq(ny).astype(np.float32)[:, None]
+    kx = np.fft.rfftfreq(nx).astype(np.float32)[None, :]
+    k = np.sqrt(kx**2 + ky**2)
+    for grid in (ky, kx, k):
+        grid.setflags(write=False)
+    return ky, kx, k
+
+
+def gaussian(shape, decay=100):
+    """exp(-decay * k)"""
+    return np.exp(-decay * frequency_grids(shape)[2])
+
+
+def lowpass(shape, cutoff=.01):
+    """1 below cutoff, 0 above"""
+    return (frequency_grids(shape)[2] < cutoff).astype(np.float32)
+
+
+def highpass(shape, cutoff=.05):
+    """0 below cutoff, 1 above"""
+    return (frequency_grids(shape)[2] > cutoff).astype(np.float32)
+
+
+def ring(shape, frequency=100):
+    """sin(frequency * k**2), concentric rings of alternating sign"""
+    return np.sin(frequency * frequency_grids(shape)[2]**2)
+
+
+def blur(shape, sigma=2.0):
+    """exp(-2 pi**2 sigma**2 k**2), a real-space Gaussian of sigma pixels with a compact response"""
+    return np.exp(-2 * np.pi**2 * sigma**2 * frequency_grids(shape)[2]**2)
+
+
+def shift(shape, x=100, y=100):
+    """Phase ramp that shifts the image (circularly) by x and y pixels."""
+    ky, kx, k = frequency_grids(shape)
+    return np.exp(-2j * np.pi * (x * kx + y * ky)).astype(np.complex64)
+
+
+KERNELS = {
+    'gaussian': gaussian,
+    'lowpass': lowpass,
+    'highpass': highpass,
+    'ring': ring,
+    'shift': shift,
+    'blur': blur,
+}
+
+
+@functools.lru_cache(maxsize=32)
+def _cached_filter(shape, name, params):
+    filt = KERNELS[name](shape, **dict(params))
+    filt.setflags(write=False)
+    return filt
+
+
+def make_filter(shape, name, **params):
+    """Return the (cached, read-only) filter `name` on the rfft2 grid of shape."""
+    if name not in KERNELS:
+        raise ValueError('unknown filter %r, choose from %s' % (name, ', '.join(sorted(KERNELS))))
+    return _cached_filter(tuple(shape[-2:]), name, tuple(sorted(params.items())))
+
+
+def spectrum(image, workers=None):
+    """rfft2 of the last two axes of image, in complex64."""
+    return fft_backend.rfftn(np.asarray(image, dtype=np.float32), axes=(-2, -1), workers=workers)
+
+
+def inverse(image_ft, shape, workers=None):
+    """irfft2 of a half-plane spectrum back to images of shape (last two axes), in float32."""
+    return fft_backend.irfftn(np.asarray(image_ft, dtype=np.complex64), s=tuple(shape[-2:]), axes=(-2, -1), workers=workers)
+
+
+def apply_filter(image, filt, workers=None):
+    """Multiply the spectrum of image (or of every image of a stack) by filt."""
+    image = np.asarray(image)
+    return inverse(spectrum(image, workers) * filt, image.shape, workers)
+
+
+def filter_image(image, name='gaussian', workers=None, **params):
+    """Filter an image, or a stack of images, with one of the KERNELS."""
+    image = np.asarray(image)
+    return apply_filter(image, make_filter(image.shape, name, **params), workers)
+
+
+def response_radius(filt, size=1024, tolerance=1e-3, **params):
+    """Half-width in pixels of the square that holds 1 - tolerance of the real-space response of a filter.
+
+    filt is the name of a kernel (with its params) or a function that returns
+    the filter for a shape. The response is the irfft2 of the filter on a
+    size x size grid; a result of size // 2 means that the response is not
+    contained in the grid, and from size // 4 on its tails wrap around the
+    grid far enough that the radius is not reliable, which gives a warning.
+    Kernels sharp in frequency
+    space have long tails: gaussian (exp(-decay * k), a Poisson kernel in real
+    space) and lowpass need hundreds to thousands of pixels, blur about four
+    times sigma.
+    """
+    if isinstance(filt, str):
+        radius = _named_radius(filt, tuple(sorted(params.items())), size, tolerance)
+    else:
+        radius = _radius(filt((size, size)), size, tolerance)
+    if radius >= size // 4:
+        warnings.warn('the real-space response of the filter is not contained in %s x %s pixels, '
+                      'tiles cannot reproduce filtering the whole image' % (size, size))
+    return radius
+
+
+@functools.lru_cache(maxsize=32)
+def _named_radius(name, params, size, tolerance):
+    return _radius(make_filter((size, size), name, **dict(params)), size, tolerance)
+
+
+def _radius(kernel, size, tolerance):
+    mass = np.abs(inverse(kernel, (size, size)))
+    # Chebyshev distance from the origin with wrap-around, tiles have square margins
+    distance = np.minimum(np.arange(size), size - np.arange(size))
+    distance = np.maximum(distance[:, None], distance[None, :])
+    cumulative = np.cumsum(np.bincount(distance.ravel(), mass.ravel().astype(np.float64)))
+    return int(np.searchsorted(cumulative, (1 - tolerance) * cumulative[-1]))
+
+
+def check_margin(filt, margin, shape, tolerance=1e-3, **params):
+    """Warn if tiles of an image of shape with this margin miss more than tolerance of the filter response."""
+    needed = response_radius(filt, min(max(shape[-2:]), 4096), tolerance, **params)
+    if margin < needed:
+        warnings.warn('a margin of %s pixels leaves more than %g of the filter response outside the tiles, '
+                      'the result differs from filtering the whole image; %s pixels are needed' % (margin, tolerance, needed))
+
+
+def filter_tiled(image, filt='gaussian', tile=1024, margin=None, out=None, batch=4, workers=None, tolerance=1e-3, **params):
+    """Filter a large 2D image tile by tile (overlap-save), with memory bounded by the tile size.
+
+    Every tile is transformed with a margin of neighbouring pixels on each
+    side, wrapping around the edges of the image like the full-image FFT
+    does, and only its centre is kept. This matches filter_image() to within
+    the part of the real-space response of the filter that lies outside the
+    margin. By default the margin is response_radius() of the filter for
+    `tolerance`; a smaller margin given explicitly gives a warning (not
+    checked with tolerance=None, for callers that checked it). An axis
+    whose tile and margins would cover the whole image is filtered whole,
+    which is exact but no longer bounds the memory by the tile size, and
+    gives a warning. filt is the name of a kernel (with its params) or a
+    function that returns the filter for a tile shape. batch tiles are
+    transformed together; out may be a preallocated (memory-mapped) array.
+    """
+    ny, nx = image.shape
+    if margin is None:
+        margin = response_radius(filt, min(max(ny, nx), 4096), tolerance, **params)
+    elif tolerance is not None:
+        check_margin(filt, margin, (ny, nx), tolerance, **params)
+    tile_y, tile_x = min(tile, ny), min(tile, nx)
+    # an axis that fits in one tile, or in one tile with its margins, is filtered whole and wraps exactly
+    if tile_y < ny and tile_y + 2 * margin >= ny or tile_x < nx and tile_x + 2 * margin >= nx:
+        warnings.warn('tiles of %s pixels with margins of %s cover the whole %s x %s image along an axis, '
+                      'which is filtered whole; the memory is not bounded by the tile size' % (tile, margin, ny, nx))
+    if tile_y + 2 * margin >= ny:
+        tile_y = ny
+    if tile_x + 2 * margin >= nx:
+        tile_x = nx
+    margin_y, margin_x = (margin if tile_y < ny else 0), (margin if tile_x < nx else 0)
+    shape = (tile_y + 2 * margin_y, tile_x + 2 * margin_x)
+    kernel = make_filter(shape, filt, **params) if isinstance(filt, str) else filt(shape)
+    if out is None:
+        out = np.empty((ny, nx), dtype=np.float32)
+    # the last row and column of tiles are moved back inside the image
+    corners = [(min(y, ny - tile_y), min(x, nx - tile_x)) for y in range(0, ny, tile_y) for x in range(0, nx, tile_x)]
+    for first in range(0, len(corners), batch):
+        group = corners[first:first + batch]
+        tiles = np.stack([image[np.ix_(np.arange(y - margin_y, y + tile_y + margin_y) % ny,
+                                       np.arange(x - margin_x, x + tile_x + margin_x) % nx)] for y, x in group])
+        filtered = apply_filter(tiles, kernel, workers)
+        for (y, x), result in zip(group, filtered):
+            out[y:y + tile_y, x:x + tile_x] = result[margin_y:margin_y + tile_y, margin_x:margin_x + tile_x]
+    return out
+
+
+class FilterSession:
+    """Spectrum of one image (or stack) kept for trying many filters on it.
+
+    The rfft2 is computed once; filtered() multiplies it by a filter and runs
+    one inverse FFT, and keeps the results of the `cache` most recently used
+    filters (least recently used are dropped first). Amplitude and phase are
+    computed on first use. Returned arrays are read-only.
+    """
+
+    def __init__(self, image, cache=16, workers=None):
+        self.image = np.asarray(image, dtype=np.float32)
+        self.workers = workers
+        self.cache = cache
+        self.spectrum = spectrum(self.image, workers)
+        self.spectrum.setflags(write=False)
+        self._amplitude = None
+        self._phase = None
+        self._results = OrderedDict()
+
+    @property
+    def amplitude(self):
+        """|spectrum| on the rfft2 grid."""
+        if self._amplitude is None:
+            self._amplitude = np.abs(self.spectrum)
+            self._amplitude.setflags(write=False)
+        return self._amplitude
+
+    @property
+    def phase(self):
+        """Phase of the spectrum in radians on the rfft2 grid."""
+        if self._phase is None:
+            self._phase = np.angle(self.spectrum).astype(np.float32)
+            self._phase.setflags(write=False)
+        return self._phase
+
+    @staticmethod
+    def centred(values):
+        """Values on the rfft2 grid with ky = 0 moved to the middle row, for display (like fftshift)."""
+        return np.fft.fftshift(values, axes=-2)
+
+    def _key(self, filt, params):
+        if isinstance(filt, str):
+            return filt, tuple(sorted(params.items()))
+        filt = np.asarray(filt)
+        return filt.shape, filt.dtype.str, hashlib.sha1(np.ascontiguousarray(filt).view(np.uint8)).hexdigest()
+
+    def filtered(self, filt='gaussian', **params):
+        """The image filtered with a kernel name (and its params) or with a filter array on the rfft2 grid."""
+        key = self._key(filt, params)
+        if key in self._results:
+            self._results.move_to_end(key)
+            return self._results[key]
+        if isinstance(filt, str):
+            filt = make_filter(self.image.shape, filt, **params)
+        result = inverse(self.spectrum * filt, self.image.shape, self.workers)
+        result.setflags(write=False)
+        self._results[key] = result
+        while len(self._results) > self.cache:
+            self._results.popitem(last=False)
+        return result
+
+    def sweep(self, name, param, values, **params):
+        """Yield (value, filtered image) for every value of one parameter of the kernel name."""
+        for value in values:
+            yield value, self.filtered(name, **dict(params, **{param: value}))
+
+    def clear(self):
+        """Drop the cached filtered images."""
+        self._results.clear()
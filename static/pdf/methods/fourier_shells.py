@@ -0,0 +1,143 @@
+"""Rotationally averaged power spectra and Fourier ring/shell correlations.
+
+    python fourier_shells.py power Micrographs/*.mrc --out power.txt
+    python fourier_shells.py fsc half1_class001.mrc half2_class001.mrc --out fsc.txt
+
+The integer shell (ring in 2D) of every element of a real FFT is computed once
+per shape and cached, together with the weight of the element in the half
+spectrum (elements with a conjugate partner that is not stored count twice).
+Radial sums are then a single np.bincount over a whole batch of images or
+volumes, with one row of shells per image.
+"""
+
+import argparse
+import functools
+
+import numpy as np
+
+import fft_backend
+import mrc_io
+
+
+@functools.lru_cache(maxsize=32)
+def shells(shape):
+    """Shell index and half-spectrum weight of every rfftn element of a 2D or 3D shape, cached.
+
+    Shells are one Fourier pixel of the largest dimension wide; elements
+    beyond Nyquist (the corners) get the index of an extra shell that is
+    dropped by the radial functions.
+    """
+    # scripts/class-wiz.py (Python 2) has its own 3D copy, mapshells(); keep the two in step
+    size = max(shape)
+    freqs = [np.fft.fftfreq(n) for n in shape[:-1]] + [np.fft.rfftfreq(shape[-1])]
+    grids = np.meshgrid(*freqs, indexing='ij', sparse=True)
+    k = np.sqrt(sum(g**2 for g in grids))
+    count = size // 2 + 1
+    index = np.minimum(np.rint(k * size).astype(np.intp), count)
+    weight = np.full(index.shape[-1], 2.0)
+    weight[0] = 1.0
+    if shape[-1] % 2 == 0:
+        weight[-1] = 1.0  # Nyquist of an even axis is its own partner
+    weight = np.broadcast_to(weight, index.shape).astype(np.float64)
+    for grid in (index, weight):
+        grid.setflags(write=False)
+    return index, weight, count
+
+
+def radial_sum(values, shape):
+    """Sum of values (batch, *rfftn shape) over every shell: (batch, shells) array."""
+    index, weight, count = shells(tuple(shape))
+    values = np.asarray(values).reshape((-1,) + index.shape)
+    batch = len(values)
+    offsets = (np.arange(batch) * (count + 1)).reshape((-1,) + (1,) * index.ndim)
+    sums = np.bincount((index + offsets).ravel(), (values * weight).ravel(), batch * (count + 1))
+    return sums.reshape(batch, count + 1)[:, :count]
+
+
+def radial_average(values, shape):
+    """Average of values (batch, *rfftn shape) over every shell: (batch, shells) array."""
+    index, weight, count = shells(tuple(shape))
+    counts = np.bincount(index.ravel(), weight.ravel(), count + 1)[:count]
+    return radial_sum(values, shape) / np.maximum(counts, 1)
+
+
+def transform(data, ndim, workers=None):
+    """rfftn over the last ndim axes of a batch in single precision."""
+    axes = tuple(range(-ndim, 0))
+    return fft_backend.rfftn(np.asarray(data, dtype=np.float32), axes=axes, workers=workers)
+
+
+def power_spectrum(images, ndim=2, workers=None):
+    """Rotationally averaged power spectrum of every image (or volume with ndim=3) of a batch."""
+    images = np.asarray(images)
+    spectra = transform(images, ndim, workers)
+    return radial_average(np.abs(spectra)**2, images.shape[-ndim:])
+
+
+def fsc(first, second, ndim=2, workers=None):
+    """Fourier ring (ndim=2) or shell (ndim=3) correlation between two batches of images or volumes.
+
+    first and second have the same shape, their last ndim axes are
+    transformed. Returns a (batch, shells) array.
+    """
+    first, second = np.asarray(first), np.asarray(second)
+    shape = first.shape[-ndim:]
+    f1, f2 = transform(first, ndim, workers), transform(second, ndim, workers)
+    cross = radial_sum((f1 * np.conj(f2)).real, shape)
+    norm = np.sqrt(radial_sum(np.abs(f1)**2, shape) * radial_sum(np.abs(f2)**2, shape))
+    return cross / np.where(norm > 0, norm, np.inf)
+
+
+frc = fsc
+
+
+def resolution(count, size, pixel=1.0):
+    """Resolution in A of the shells 0..count-1 of shells(), size is the largest dimension (inf for shell 0)."""
+    with np.errstate(divide='ignore'):
+        return size * pixel / np.arange(count, dtype=np.float64)
+
+
+def write_curves(path, curves, names, size, pixel):
+    """Table of curves (batch, shells) with a shell and a resolution column."""
+    curves = np.atleast_2d(curves)
+    table = np.column_stack([np.arange(curves.shape[1]), resolution(curves.shape[1], size, pixel), curves.T])
+    np.savetxt(path, table, fmt='%.6g', delimiter='\t', header='\t'.join(['Shell', 'Resolution'] + list(names)), comments='')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Radial power spectra and Fourier ring/shell correlations of MRC files')
+    parser.add_argument('mode', choices=['power', 'fsc'], help='power: average power spectrum of every file; fsc: correlation between two files')
+    parser.add_argument('inputs', nargs='+', help='.mrc/.mrcs files (two for fsc)')
+    parser.add_argument('--out', required=True, help='output table')
+    parser.add_argument('--chunk', type=int, default=16, help='images transformed at a time (default: 16)')
+    parser.add_argument('--threads', type=int, default=None, help='FFT threads (default: the count chosen by fft_backend.py benchmark, or one)')
+    args = parser.parse_args(argv)
+
+    if args.mode == 'fsc':
+        if len(args.inputs) != 2:
+            parser.error('fsc needs two files')
+        (first, pixel), (second, _) = mrc_io.read_mrc(args.inputs[0]), mrc_io.read_mrc(args.inputs[1])
+        volume = mrc_io.is_volume(args.inputs[0])
+        if volume:
+            curve = fsc(first, second, 3, args.threads)
+        else:  # average ring correlation of the sections
+            curve = np.concatenate([fsc(first[i:i + args.chunk], second[i:i + args.chunk], 2, args.threads)
+                                    for i in range(0, len(first), args.chunk)]).mean(axis=0)
+        write_curves(args.out, curve, ['FSC' if volume else 'FRC'], max(first.shape[-3 if volume else -2:]), pixel)
+        return
+
+    curves, names, shape = [], [], None
+    for path in args.inputs:
+        data, pixel = mrc_io.read_mrc(path)
+        if shape is not None and data.shape[1:] != shape:
+            parser.error('%s is not %s x %s like %s' % (path, shape[1], shape[0], args.inputs[0]))
+        shape = data.shape[1:]
+        sums = sum(power_spectrum(data[i:i + args.chunk], 2, args.threads).sum(axis=0)
+                   for i in range(0, len(data), args.chunk))
+        curves.append(sums / len(data))
+        names.append(path)
+    write_curves(args.out, np.array(curves), names, max(shape), pixel)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Memory-mapped MRC files (images, stacks and volumes).
+
+Only the 1024-byte header is read or written; the data are accessed through a
+numpy memmap of shape (sections, ny, nx), so stacks of any size can be
+processed a few sections at a time.
+"""
+
+import numpy as np
+
+HEADER_BYTES = 1024
+
+# MRC data modes and their numpy types
+MODES = {0: 'i1', 1: 'i2', 2: 'f4', 6: 'u2', 12: 'f2'}
+
+
+def read_header(path):
+    """Return nx, ny, nz, mode, voxel size (A), extended header bytes and byte order of an MRC file."""
+    header = np.fromfile(path, dtype='<i4', count=256)
+    byteorder = '<'
+    if not 0 <= header[3] < 20:  # mode does not make sense, big endian file
+        header = header.byteswap()
+        byteorder = '>'
+    cell = header[10:13].view(np.float32)
+    nx, ny, nz, mode = (int(v) for v in header[:4])
+    mx = int(header[7]) or nx
+    voxel = float(cell[0]) / mx if cell[0] > 0 else 1.0
+    return nx, ny, nz, mode, voxel, int(header[23]), byteorder
+
+
+def is_volume(path):
+    """True for a 3D map (space group 1 or more), False for an image or a stack of images."""
+    header = np.fromfile(path, dtype='<i4', count=256)
+    if not 0 <= header[3] < 20:
+        header = header.byteswap()
+    return header[22] > 0 and header[2] > 1
+
+
+def read_mrc(path, mode='r'):
+    """Memory-map the data of an MRC file: returns (array of shape (nz, ny, nx), voxel size)."""
+    # scripts/class-wiz.py (Python 2) has its own copy, mrcmap(); keep the two in step
+    nx, ny, nz, data_mode, voxel, extended, byteorder = read_header(path)
+    if data_mode not in MODES:
+        raise ValueError('%s: MRC mode %s is not supported' % (path, data_mode))
+    data = np.memmap(path, dtype=byteorder + MODES[data_mode], mode=mode,
+                     offset=HEADER_BYTES + extended, shape=(nz, ny, nx))
+    return data, voxel
+
+
+def create_mrc(path, shape, voxel=1.0, volume=False):
+    """Create a float32 MRC file of shape (nz, ny, nx) and return it memory-mapped for writing.
+
+    The file is allocated at its full size; call update_stats() once the
+    data are written. volume marks a 3D map (space group 1) instead of an
+    image stack (space group 0).
+    """
+    nz, ny, nx = shape
+    header = np.zeros(256, dtype='<i4')
+    header[:3] = nx, ny, nz
+    header[3] = 2
+    mz = nz if volume else 1  # a stack of images is one section deep
+    header[7:10] = nx, ny, mz
+    header[10:13] = np.array([nx * voxel, ny * voxel, mz * voxel], dtype='<f4').view('<i4')
+    header[13:16] = np.array([90, 90, 90], dtype='<f4').view('<i4')
+    header[16:19] = 1, 2, 3
+    header[22] = 1 if volume else 0
+    header[27] = 20140
+    header[52] = np.frombuffer(b'MAP ', dtype='<i4')[0]
+    header[53] = np.frombuffer(b'DD\x00\x00', dtype='<i4')[0]
+    with open(path, 'wb') as f:
+        header.tofile(f)
+        f.truncate(HEADER_BYTES + 4 * nx * ny * nz)
+    return np.memmap(path, dtype='<f4', mode='r+', offset=HEADER_BYTES, shape=(nz, ny, nx))
+
+
+def update_stats(path, minimum, maximum, mean, rms):
+    """Write the density statistics (dmin, dmax, dmean, rms) into the header of an MRC file."""
+    with open(path, 'r+b') as f:
+        f.seek(19 * 4)
+        np.array([minimum, maximum, mean], dtype='<f4').tofile(f)
+        f.seek(54 * 4)
+        np.array([rms], dtype='<f4').tofile(f)
+
+
+def finish_mrc(path, data, chunk=16):
+    """Flush the memory-mapped data of an MRC file made by create_mrc() and write its statistics."""
+    stats = RunningStats()
+    for start in range(0, len(data), chunk):
+        stats.add(data[start:start + chunk])
+    data.flush()
+    update_stats(path, *stats.result())
+
+
+def write_mrc(path, data, voxel=1.0, volume=False):
+    """Write an array of shape (nz, ny, nx) as a float32 MRC file."""
+    out = create_mrc(path, data.shape, voxel, volume)
+    out[:] = data
+    finish_mrc(path, out)
+
+
+class RunningStats:
+    """Minimum, maximum, mean and rms of data seen a chunk at a time."""
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0.0
+        self.squares = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    def add(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        self.n += chunk.size
+        self.total += chunk.sum()
+        self.squares += np.square(chunk).sum()
+        self.minimum = min(self.minimum, chunk.min())
+        self.maximum = max(self.maximum, chunk.max())
+
+    def result(self):
+        """Return minimum, maximum, mean and rms (standard deviation)."""
+        mean = self.total / self.n
+        return self.minimum, self.maximum, mean, np.sqrt(max(self.squares / self.n - mean**2, 0))